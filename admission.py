@@ -0,0 +1,207 @@
+"""
+Контроль памяти для одновременных генераций.
+
+Перед запуском каждая генерация оценивает свой пиковый расход памяти по параметрам
+(длительность MusicGen, длина текста для XTTS) и резервирует его в общем бюджете.
+Если бюджета не хватает, задание ждёт в очереди; если очередь переполнена —
+сразу получает AdmissionRejected (backpressure). Оценка калибруется по пиковому
+RSS задания за вычетом RSS простоя после загрузки моделей (mark_idle): прирост
+относительно старта задания не годится — аллокаторы PyTorch/glibc переиспользуют
+уже занятую память, и после первого запуска он близок к нулю.
+"""
+import gc
+import os
+import threading
+from contextlib import contextmanager
+
+from cancellation import check
+from helpers import log
+
+MB = 1024 * 1024
+
+# Априорная модель: базовый расход + расход на единицу параметра (МБ).
+# MusicGen: ~50 шагов/с, KV-кэш 24 слоёв x 2 (CFG) растёт линейно с длительностью.
+# XTTS: латенты GPT и вокодер растут с длиной текста.
+PRIORS = {
+    "music": (300, 24.0),   # на секунду аудио
+    "music_final": (1500, 60.0),  # модель финального уровня (medium и больше)
+    "tts": (400, 1.5),      # на символ текста
+}
+
+# Калибровочный коэффициент держим в разумных пределах
+MIN_SCALE, MAX_SCALE = 0.5, 4.0
+CALIBRATION_ALPHA = 0.3
+RSS_SAMPLE_INTERVAL = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Очередь ожидания памяти переполнена — клиенту стоит повторить позже"""
+
+
+def read_rss():
+    """Текущий RSS процесса в байтах (psutil, /proc или 0 если недоступно)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def default_budget_mb():
+    env = os.environ.get("LEON_MEMORY_BUDGET_MB")
+    if env:
+        return int(env)
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        # Остальное занимают сами модели, Gradio и система
+        return int(total * 0.5 / MB)
+    except (ValueError, OSError, AttributeError):
+        return 8192
+
+
+def release_memory():
+    """Сразу освобождает промежуточные тензоры после этапа генерации"""
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class AdmissionController:
+    def __init__(self, budget_mb=None, max_waiting=None):
+        self.budget = (budget_mb or default_budget_mb()) * MB
+        self.max_waiting = max_waiting if max_waiting is not None else int(os.environ.get("LEON_ADMISSION_QUEUE", "8"))
+        self.reserved = 0
+        self.active = {}
+        # Задания, рядом с которыми хоть раз работало другое: их пиковый RSS не разделить
+        self.overlapped = set()
+        self.waiting = 0
+        self.scale = {kind: 1.0 for kind in PRIORS}
+        # RSS процесса с загруженными моделями без заданий; None — калибровка выключена
+        self.idle_rss = None
+        self._next_id = 0
+        self._cond = threading.Condition()
+
+    def mark_idle(self):
+        """Запоминает RSS простоя; вызывается после загрузки моделей"""
+        gc.collect()
+        self.idle_rss = read_rss() or None
+        if self.idle_rss:
+            log(f"[Memory] Idle RSS with models loaded: {self.idle_rss / MB:.0f} MB")
+
+    def estimate(self, kind, amount):
+        """Оценка пикового расхода в байтах для одного этапа"""
+        base, per_unit = PRIORS[kind]
+        return int((base + per_unit * amount) * self.scale[kind] * MB)
+
+    def estimate_job(self, stages):
+        """stages: {"music": duration, "tts": len(text)}; этапы идут последовательно — берём максимум"""
+        return max(self.estimate(kind, amount) for kind, amount in stages.items())
+
+    def is_saturated(self):
+        with self._cond:
+            return self.waiting >= self.max_waiting
+
+    @contextmanager
+    def admit(self, stages, progress_fn=None, cancel_token=None):
+        """Резервирует память под задание на время выполнения блока"""
+        cost = self.estimate_job(stages)
+        with self._cond:
+            if not self._fits(cost):
+                if self.waiting >= self.max_waiting:
+                    raise AdmissionRejected(
+                        f"Memory queue is full ({self.waiting} waiting), try again later"
+                    )
+                self.waiting += 1
+                if progress_fn:
+                    progress_fn(0.02, f"⏳ Ожидание свободной памяти (~{cost / MB:.0f} МБ)...")
+                log(f"[Memory] Job needs {cost / MB:.0f} MB, waiting "
+                    f"({self.reserved / MB:.0f}/{self.budget / MB:.0f} MB reserved)")
+                try:
+                    while not self._fits(cost):
+                        check(cancel_token)
+                        self._cond.wait(1.0)
+                finally:
+                    self.waiting -= 1
+            self._next_id += 1
+            ticket = self._next_id
+            self.reserved += cost
+            # Новое задание перекрывается со всеми уже идущими, и они — с ним
+            self.overlapped.update(self.active)
+            self.active[ticket] = cost
+            alone = len(self.active) == 1
+
+        monitor = _PeakRSSMonitor() if alone and self.idle_rss else None
+        try:
+            yield cost
+        finally:
+            release_memory()
+            with self._cond:
+                self.reserved -= self.active.pop(ticket)
+                overlapped = not alone or ticket in self.overlapped
+                self.overlapped.discard(ticket)
+                self._cond.notify_all()
+            if monitor and not overlapped:
+                # Калибруем только по заданиям, которые от начала до конца шли в одиночку — иначе
+                # прирост не разделить. idle_rss берём на конец задания: модель могла загрузиться во время него
+                self._calibrate(stages, cost, monitor.stop() - self.idle_rss)
+
+    def _fits(self, cost):
+        # Задание больше всего бюджета всё равно пускаем, но только когда больше никто не работает
+        return self.reserved + cost <= self.budget or not self.active
+
+    def _calibrate(self, stages, estimated, measured):
+        if measured <= 0 or estimated <= 0:
+            return
+        # Весь прирост относим к самому дорогому этапу
+        kind = max(stages, key=lambda k: self.estimate(k, stages[k]))
+        ratio = measured / estimated
+        with self._cond:
+            new_scale = self.scale[kind] * ((1 - CALIBRATION_ALPHA) + CALIBRATION_ALPHA * ratio)
+            self.scale[kind] = min(max(new_scale, MIN_SCALE), MAX_SCALE)
+        log(f"[Memory] {kind}: estimated {estimated / MB:.0f} MB, measured {measured / MB:.0f} MB, "
+            f"scale {self.scale[kind]:.2f}")
+
+    def snapshot(self):
+        """Зарезервировано по оценкам vs фактический RSS"""
+        with self._cond:
+            return {
+                "budget_mb": round(self.budget / MB),
+                "reserved_mb": round(self.reserved / MB),
+                "rss_mb": round(read_rss() / MB),
+                "active_jobs": len(self.active),
+                "waiting_jobs": self.waiting,
+                "scale": {k: round(v, 3) for k, v in self.scale.items()},
+            }
+
+
+class _PeakRSSMonitor:
+    """Фоновый замер пикового RSS за время задания"""
+
+    def __init__(self):
+        self.baseline = read_rss()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, read_rss())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return max(self.peak, read_rss())
+
+
+controller = AdmissionController()
+log(f"[Memory] Generation budget: {controller.budget / MB:.0f} MB")
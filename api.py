@@ -0,0 +1,362 @@
+"""
+Headless HTTP API рядом с Gradio-интерфейсом.
+
+POST /api/music, /api/tts, /api/song  -> {"job_id": ...} сразу
+POST /api/music/draft, /api/music/refine -> черновик и его финальный рендер
+POST /api/tts/multi                   -> один текст несколькими голосами (стемы или дуэт)
+GET  /api/jobs/{id}                   -> статус и прогресс
+POST /api/jobs/{id}/cancel            -> остановить задание (в очереди или на ходу)
+GET  /api/jobs/{id}/events            -> прогресс через server-sent events
+GET  /api/jobs/{id}/result            -> файл результата (чанками, поддерживает Range; ?index=N для стемов)
+GET  /api/projects, POST /api/projects/{name}/remix -> стемы песен и быстрый ремикс
+GET  /api/profiles                    -> самые медленные профилированные запросы ("profile": true в теле POST)
+GET  /api/queue                       -> планировщик: кто выполняется и кто ждёт, модель времени
+GET  /api/memory                      -> бюджет памяти: зарезервировано vs фактический RSS, кэш строк вокала
+
+Для локальной проверки без моделей: LEON_STUB_MODELS=1 python main.py
+"""
+import json
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from admission import controller as admission
+from profiling import slowest_profiles
+from helpers import VOICE_DIR
+from jobs import DONE, manager
+from projects import list_projects, load_mix, remix_project
+from vocal_cache import CROSSFADE_MS, GAP_MS, cache as vocal_cache
+from writebehind import writer
+from scheduler import scheduler
+from cancellation import wasted
+from cost_model import model as cost_model
+from music_workflow import (
+    generate_music_draft, generate_music_workflow, generate_song_with_voice, generate_tts_voice,
+    generate_multi_voice, refine_music_workflow, MULTI_VOICE_MODES, MUSICGEN_TIERS,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+router = APIRouter(prefix="/api")
+
+
+class MusicRequest(BaseModel):
+    prompt: str
+    duration: int = Field(20, ge=1, le=60)
+    track_name: str = "Leon_music"
+    profile: Optional[bool] = None
+
+
+class DraftRequest(BaseModel):
+    prompt: str
+    track_name: str = "Leon_music"
+    profile: Optional[bool] = None
+
+
+class RefineRequest(BaseModel):
+    prompt: str
+    draft_job_id: str
+    duration: int = Field(30, ge=1, le=60)
+    track_name: str = "Leon_music"
+    tier: str = "final"
+    profile: Optional[bool] = None
+
+
+class RemixRequest(BaseModel):
+    vocal_gain_db: Optional[float] = None
+    music_gain_db: Optional[float] = None
+    vocal_offset_ms: Optional[int] = None
+    fade_in_ms: Optional[int] = None
+    fade_out_ms: Optional[int] = None
+    normalize: Optional[bool] = None
+    # Полное описание сведения (tracks/master/length) поверх текущего
+    mix: Optional[dict] = None
+
+
+class TTSRequest(BaseModel):
+    lyrics: str
+    voice: str
+    gap_ms: int = Field(GAP_MS, ge=0, le=5000)
+    crossfade_ms: int = Field(CROSSFADE_MS, ge=0, le=1000)
+    profile: Optional[bool] = None
+
+
+class MultiVoiceRequest(BaseModel):
+    lyrics: str
+    voices: List[str] = Field(..., min_length=2, max_length=8)
+    mode: str = "stems"
+    gap_ms: int = Field(GAP_MS, ge=0, le=5000)
+    crossfade_ms: int = Field(CROSSFADE_MS, ge=0, le=1000)
+    profile: Optional[bool] = None
+
+
+class SongRequest(BaseModel):
+    lyrics: str
+    voice: str
+    genre: str = "pop"
+    duration: int = Field(30, ge=1, le=60)
+    gap_ms: int = Field(GAP_MS, ge=0, le=5000)
+    crossfade_ms: int = Field(CROSSFADE_MS, ge=0, le=1000)
+    profile: Optional[bool] = None
+
+
+def resolve_voice(voice: str) -> str:
+    """Принимает только имя файла из VOICE_DIR, чтобы нельзя было выйти за пределы папки"""
+    path = VOICE_DIR / Path(voice).name
+    if not path.is_file():
+        raise HTTPException(404, f"Voice not found: {voice}")
+    return str(path)
+
+
+def get_job_or_404(job_id):
+    job = manager.get(job_id)
+    if job is None:
+        raise HTTPException(404, f"Job not found: {job_id}")
+    return job
+
+
+def check_backpressure():
+    """Если очередь планировщика или ожидания памяти заполнена — не принимаем новые задания"""
+    if scheduler.is_saturated(manager.pending()) or admission.is_saturated():
+        raise HTTPException(429, "Server is busy, try again later", headers={"Retry-After": "30"})
+
+
+def client_id(request):
+    """Пользователь для справедливой очереди: заголовок X-User или адрес клиента"""
+    return request.headers.get("x-user") or (request.client.host if request.client else None)
+
+
+def submitted(job):
+    return {"job_id": job.id, "status": job.status}
+
+
+@router.post("/music", status_code=202)
+def submit_music(req: MusicRequest, request: Request):
+    check_backpressure()
+    job = manager.submit(
+        "music", generate_music_workflow,
+        prompt=req.prompt, duration=req.duration, track_name=req.track_name, profile=req.profile,
+        user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.post("/music/draft", status_code=202)
+def submit_draft(req: DraftRequest, request: Request):
+    check_backpressure()
+    job = manager.submit(
+        "draft", generate_music_draft,
+        prompt=req.prompt, track_name=req.track_name, profile=req.profile,
+        user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.post("/music/refine", status_code=202)
+def submit_refine(req: RefineRequest, request: Request):
+    check_backpressure()
+    if req.tier not in MUSICGEN_TIERS:
+        raise HTTPException(400, f"Unknown tier: {req.tier}")
+    draft = get_job_or_404(req.draft_job_id)
+    if draft.status != DONE or not draft.result:
+        raise HTTPException(409, f"Draft job is {draft.status}")
+    job = manager.submit(
+        "refine", refine_music_workflow,
+        draft_path=draft.result, prompt=req.prompt, duration=req.duration,
+        track_name=req.track_name, tier=req.tier, profile=req.profile, user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.post("/tts", status_code=202)
+def submit_tts(req: TTSRequest, request: Request):
+    check_backpressure()
+    if not req.lyrics.strip():
+        raise HTTPException(400, "Lyrics are empty")
+    job = manager.submit(
+        "tts", generate_tts_voice,
+        lyrics=req.lyrics, voice_path=resolve_voice(req.voice),
+        gap_ms=req.gap_ms, crossfade_ms=req.crossfade_ms, profile=req.profile, user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.post("/tts/multi", status_code=202)
+def submit_multi_voice(req: MultiVoiceRequest, request: Request):
+    check_backpressure()
+    if not req.lyrics.strip():
+        raise HTTPException(400, "Lyrics are empty")
+    if req.mode not in MULTI_VOICE_MODES:
+        raise HTTPException(400, f"Unknown mode: {req.mode}")
+    job = manager.submit(
+        "tts_multi", generate_multi_voice,
+        lyrics=req.lyrics, voice_paths=[resolve_voice(v) for v in req.voices], mode=req.mode,
+        gap_ms=req.gap_ms, crossfade_ms=req.crossfade_ms, profile=req.profile, user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.post("/song", status_code=202)
+def submit_song(req: SongRequest, request: Request):
+    check_backpressure()
+    if not req.lyrics.strip():
+        raise HTTPException(400, "Lyrics are empty")
+    job = manager.submit(
+        "song", generate_song_with_voice,
+        lyrics=req.lyrics, genre=req.genre, duration=req.duration,
+        voice_sample_path=resolve_voice(req.voice), gap_ms=req.gap_ms, crossfade_ms=req.crossfade_ms,
+        profile=req.profile, user=client_id(request),
+    )
+    return submitted(job)
+
+
+@router.get("/projects")
+def projects_list():
+    return {"projects": list_projects()}
+
+
+@router.get("/projects/{project}")
+def project_mix(project: str):
+    try:
+        return load_mix(project)
+    except Exception as e:
+        raise HTTPException(404, str(e))
+
+
+@router.post("/projects/{project}/remix")
+def project_remix(project: str, req: RemixRequest):
+    """Синхронно: пересведение из стемов занимает миллисекунды"""
+    try:
+        output = remix_project(project, **req.dict())
+    except Exception as e:
+        raise HTTPException(404 if "not found" in str(e) else 400, str(e))
+    return {"project": project, "output": Path(output).name}
+
+
+@router.get("/profiles")
+def profiles_index():
+    """Самые медленные из снятых профилей (файлы лежат в Leon_profiles/)"""
+    return {"profiles": slowest_profiles()}
+
+
+@router.get("/memory")
+def memory_status():
+    return dict(admission.snapshot(), vocal_cache=vocal_cache.snapshot())
+
+
+@router.get("/queue")
+def queue_status():
+    return dict(scheduler.snapshot(), cost_model=cost_model.snapshot(), cancelled=wasted.snapshot())
+
+
+@router.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    return get_job_or_404(job_id).to_dict()
+
+
+@router.post("/jobs/{job_id}/cancel")
+def job_cancel(job_id: str):
+    job = get_job_or_404(job_id)
+    if job.is_final:
+        raise HTTPException(409, f"Job is {job.status}")
+    return manager.cancel(job_id).to_dict()
+
+
+@router.get("/jobs/{job_id}/events")
+def job_events(job_id: str):
+    job = get_job_or_404(job_id)
+
+    def stream():
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                yield f"event: progress\ndata: {json.dumps(job.to_dict())}\n\n"
+            if job.is_final:
+                yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+                return
+            # Пустые изменения = keep-alive комментарий, чтобы прокси не рвали соединение
+            if job.wait_for_change(version) == version:
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+def parse_range(header, size):
+    """Разбирает 'bytes=start-end' и возвращает (start, end) включительно или None"""
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].split(",")[0].strip()
+    start_s, _, end_s = spec.partition("-")
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+        else:
+            # bytes=-N — последние N байт
+            start = max(size - int(end_s), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(416, "Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+def iter_file(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@router.get("/jobs/{job_id}/result")
+def job_result(job_id: str, request: Request, index: int = 0):
+    """index — номер файла, если задание вернуло несколько (стемы голосов)"""
+    job = get_job_or_404(job_id)
+    if not job.is_final:
+        raise HTTPException(409, f"Job is {job.status}")
+    path = job.result
+    if isinstance(path, list):
+        if not 0 <= index < len(path):
+            raise HTTPException(404, f"Job has {len(path)} result files")
+        path = path[index]
+    try:
+        # Генерация закончилась, но файл может ещё дописываться в фоне
+        writer.wait_for(path)
+    except Exception as e:
+        raise HTTPException(410, str(e))
+    if job.status != DONE or not path or not os.path.isfile(path):
+        raise HTTPException(410, job.error or "Result is not available")
+
+    size = os.path.getsize(path)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{Path(path).name}"',
+    }
+    byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file(path, 0, size), media_type="audio/wav", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file(path, start, end - start + 1), status_code=206,
+                             media_type="audio/wav", headers=headers)
+
+
+def create_api_app():
+    app = FastAPI(title="Leon Vibe Creator API")
+    app.include_router(router)
+    return app
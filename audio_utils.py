@@ -1,9 +1,31 @@
+import os
 import numpy as np
 from pydub import AudioSegment
+from resample import resample
+from wav_reader import open_audio
 
-def audio_write(path: str, audio_tensor, sample_rate: int):
-    audio_np = audio_tensor.cpu().numpy()
+# Частота итоговых файлов; по умолчанию — родная частота модели
+EXPORT_SAMPLE_RATE = int(os.environ.get("LEON_EXPORT_SAMPLE_RATE", "0")) or None
+
+def audio_write(path: str, audio_tensor, sample_rate: int, apply_export_rate: bool = True):
+    """Пишет моно WAV 16 бит; принимает torch тензор или numpy массив со значениями [-1, 1]"""
+    audio_np = audio_tensor.cpu().numpy() if hasattr(audio_tensor, "cpu") else np.asarray(audio_tensor)
     if audio_np.ndim > 1:
         audio_np = audio_np[0]
-    audio_int16 = (audio_np * 32767).astype(np.int16)
-    AudioSegment(audio_int16.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1).export(path, format="wav")
\ No newline at end of file
+    if apply_export_rate and EXPORT_SAMPLE_RATE and EXPORT_SAMPLE_RATE != sample_rate:
+        audio_np = resample(audio_np, sample_rate, EXPORT_SAMPLE_RATE)
+        sample_rate = EXPORT_SAMPLE_RATE
+    audio_int16 = (np.clip(audio_np, -1.0, 1.0) * 32767).astype(np.int16)
+    AudioSegment(audio_int16.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1).export(path, format="wav")
+
+def audio_read(path: str, start: float = 0.0, end: float = None, mono: bool = False):
+    """
+    Читает аудио файл (или отрезок [start, end) в секундах) в float32 массив [channels, samples]
+    и частоту дискретизации; mono — один канал со средним. WAV читается через отображение в память.
+    """
+    # Файл мог быть только что отдан фоновому писателю
+    from writebehind import writer
+    writer.wait_for(path)
+    with open_audio(path) as audio:
+        samples = audio.read_seconds(start, end, mono=mono)
+        return (samples[None] if mono else samples), audio.sample_rate
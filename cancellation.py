@@ -0,0 +1,114 @@
+"""
+Кооперативная отмена генераций.
+
+Поток с musicgen.generate или XTTS нельзя убить снаружи, поэтому каждая генерация
+получает CancelToken и сама проверяет его в безопасных точках: в колбэке прогресса
+MusicGen между шагами токенов, между строками TTS, в ожидании очереди и памяти.
+cancel() из другого потока (кнопка Stop, закрытие вкладки, POST /api/jobs/{id}/cancel)
+приводит к исключению Cancelled в ближайшей такой точке — модель освобождается
+для следующего задания. Время моделей, потраченное на отменённые задания, считается.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from helpers import log
+
+
+class Cancelled(Exception):
+    """Генерация отменена пользователем"""
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+        self.cancelled_at = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled by user"):
+        if not self._event.is_set():
+            self.reason = reason
+            self.cancelled_at = time.time()
+            self._event.set()
+
+    def check(self):
+        """Бросает Cancelled, если отмена уже запрошена"""
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+
+def check(token):
+    """token.check() для необязательного токена"""
+    if token is not None:
+        token.check()
+
+
+class CancelRegistry:
+    """
+    Токены активных генераций по владельцу — паре (сессия Gradio, вкладка): Stop
+    останавливает только генерации своей вкладки, закрытие вкладки — все генерации сессии.
+    """
+
+    def __init__(self):
+        self._tokens = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def open(self, owner):
+        token = CancelToken()
+        with self._lock:
+            self._tokens[owner].add(token)
+        return token
+
+    def close(self, owner, token):
+        with self._lock:
+            tokens = self._tokens.get(owner)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens[owner]
+
+    def cancel(self, owner, reason="cancelled by user"):
+        """Отменяет все генерации владельца, возвращает их число"""
+        with self._lock:
+            tokens = list(self._tokens.get(owner, ()))
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+    def cancel_session(self, session, reason="cancelled by user"):
+        """Отменяет генерации сессии на всех вкладках, возвращает их число"""
+        with self._lock:
+            tokens = [token for (owner_session, _), owned in self._tokens.items()
+                      if owner_session == session for token in owned]
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+
+class _WasteCounter:
+    """Секунды работы моделей, выброшенные из-за отмены"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.count = defaultdict(int)
+
+    def record(self, kind, seconds):
+        with self._lock:
+            self.seconds[kind] += seconds
+            self.count[kind] += 1
+            total = sum(self.seconds.values())
+        log(f"[Cancel] {kind} cancelled after {seconds:.1f} sec of compute ({total:.0f} sec wasted in total)")
+
+    def snapshot(self):
+        with self._lock:
+            return {kind: {"cancelled": self.count[kind], "wasted_seconds": round(self.seconds[kind], 1)}
+                    for kind in self.seconds}
+
+
+registry = CancelRegistry()
+wasted = _WasteCounter()
@@ -0,0 +1,134 @@
+"""
+Модель времени генерации, обучаемая на лету.
+
+Для каждого этапа время считается как seconds = a + b * x, где x — параметр этапа
+(секунды аудио для MusicGen, число синтезируемых символов для XTTS). Коэффициенты
+подбираются взвешенным МНК по замерам: старые замеры затухают (DECAY), а априорная
+прямая входит парой фиксированных псевдо-замеров — пока данных мало или все запросы
+одинаковой длины, оценка не уходит в сторону. Статистика сохраняется в JSON и
+переживает перезапуск. Оценки используются для ETA и планировщика (scheduler.py).
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+from helpers import OUTPUT_DIR, log
+
+MODEL_FILE = Path(os.environ.get("LEON_COST_MODEL", str(OUTPUT_DIR / ".cost_model.json")))
+
+# Априорные прямые (a секунд, b секунд на единицу) и типичное значение x этапа.
+# Раньше это были константы в music_workflow: duration*1.5 и len(lyrics)*0.2..0.3
+PRIORS = {
+    "music_draft": (0.0, 1.5, 30),     # на секунду аудио, модель уровня draft
+    "music_final": (0.0, 1.5 * float(os.environ.get("LEON_FINAL_SLOWDOWN", "3.0")), 30),
+    "tts": (0.0, 0.25, 200),           # на синтезируемый символ
+}
+DEFAULT_PRIOR = (0.0, 1.0, 30)
+PRIOR_WEIGHT = 1.0
+# Вес замера умножается на DECAY при каждом новом — модель следует за сменой железа
+DECAY = 0.95
+MIN_SECONDS = 0.5
+
+
+class _Stage:
+    """Затухающие суммы для МНК: w, wx, wy, wxx, wxy"""
+
+    def __init__(self, prior, sums=None, count=0):
+        self.prior = prior
+        self.sums = list(sums or [0.0] * 5)
+        self.count = count
+
+    def observe(self, x, y):
+        self.sums = [s * DECAY for s in self.sums]
+        for i, v in enumerate((1.0, x, y, x * x, x * y)):
+            self.sums[i] += v
+        self.count += 1
+
+    def coefficients(self):
+        a0, b0, ref = self.prior
+        w, wx, wy, wxx, wxy = self.sums
+        # Псевдо-замеры на априорной прямой в точках ref/4 и ref
+        for x in (ref / 4, ref):
+            y = a0 + b0 * x
+            w, wx, wy, wxx, wxy = (w + PRIOR_WEIGHT, wx + PRIOR_WEIGHT * x, wy + PRIOR_WEIGHT * y,
+                                   wxx + PRIOR_WEIGHT * x * x, wxy + PRIOR_WEIGHT * x * y)
+        det = w * wxx - wx * wx
+        if det <= 1e-9:
+            return a0, b0
+        b = (w * wxy - wx * wy) / det
+        a = (wy - b * wx) / w
+        if b < 0:
+            # Время не может убывать с длиной: оставляем только среднее
+            b = 0.0
+            a = wy / w
+        return a, b
+
+    def to_dict(self):
+        return {"sums": self.sums, "count": self.count}
+
+
+class CostModel:
+    def __init__(self, path=MODEL_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._load()
+
+    def _stage(self, name):
+        if name not in self._stages:
+            self._stages[name] = _Stage(PRIORS.get(name, DEFAULT_PRIOR))
+        return self._stages[name]
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log(f"[CostModel] Can't read {self.path}: {e}, starting from priors")
+            return
+        for name, state in data.get("stages", {}).items():
+            self._stages[name] = _Stage(PRIORS.get(name, DEFAULT_PRIOR), state.get("sums"), state.get("count", 0))
+
+    def _save(self):
+        data = {"stages": {name: stage.to_dict() for name, stage in self._stages.items()}}
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log(f"[CostModel] Can't save {self.path}: {e}")
+
+    def estimate(self, stage, x):
+        """Ожидаемое время этапа в секундах"""
+        with self._lock:
+            a, b = self._stage(stage).coefficients()
+        return max(a + b * float(x), MIN_SECONDS)
+
+    def estimate_job(self, stages):
+        """Сумма по этапам: {"tts": символы, "music_draft": секунды}"""
+        return sum(self.estimate(stage, x) for stage, x in stages.items() if x)
+
+    def observe(self, stage, x, seconds):
+        """Добавляет замер этапа и сохраняет модель"""
+        if x <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            s = self._stage(stage)
+            predicted = max(sum(c * v for c, v in zip(s.coefficients(), (1.0, float(x)))), MIN_SECONDS)
+            s.observe(float(x), float(seconds))
+            self._save()
+        log(f"[CostModel] {stage}: x={x:g}, predicted {predicted:.1f} sec, measured {seconds:.1f} sec")
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, stage in self._stages.items():
+                a, b = stage.coefficients()
+                result[name] = {"a": round(a, 3), "b": round(b, 4), "observations": stage.count}
+            return result
+
+
+# Общая модель процесса
+model = CostModel()
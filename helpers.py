@@ -4,10 +4,15 @@ from colorama import Fore, Style
 import shutil
 import uuid
 import time
+import threading
 
 OUTPUT_DIR = Path("Leon_vibe")
 VOICE_DIR = Path("Leon_voice")
 
+# Голоса храним моно WAV на частоте, с которой XTTS читает референс
+VOICE_SAMPLE_RATE = 22050
+VOICE_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a")
+
 # Создаем папки если их нет
 OUTPUT_DIR.mkdir(exist_ok=True)
 VOICE_DIR.mkdir(exist_ok=True)
@@ -23,23 +28,83 @@ def get_filename_only(file_path: str) -> str:
     """Возвращает только имя файла без пути"""
     return Path(file_path).name
 
+# Кэш списка аудио файлов: пересобирается, только если изменилась папка
+# (mtime каталога) или кто-то явно сбросил его через invalidate_audio_index()
+_audio_index = {"dir_mtime": None, "files": []}
+_audio_index_lock = threading.Lock()
+
+# Файлы, которые фоновый писатель ещё не положил на диск (см. writebehind.py)
+_pending_outputs = set()
+
+def set_output_pending(path_str, pending):
+    with _audio_index_lock:
+        if pending:
+            _pending_outputs.add(path_str)
+        else:
+            _pending_outputs.discard(path_str)
+
+def invalidate_audio_index():
+    """Сбрасывает кэш списка файлов (после записи или удаления в OUTPUT_DIR)"""
+    with _audio_index_lock:
+        _audio_index["dir_mtime"] = None
+
 def list_audio_files():
     """Возвращает список полных путей к аудио файлам"""
-    files = list(OUTPUT_DIR.glob("*.wav")) + list(OUTPUT_DIR.glob("*.mp3"))
-    files.sort(key=os.path.getmtime, reverse=True)
-    return [str(p.resolve()) for p in files]
+    with _audio_index_lock:
+        dir_mtime = OUTPUT_DIR.stat().st_mtime_ns
+        if _audio_index["dir_mtime"] != dir_mtime:
+            files = list(OUTPUT_DIR.glob("*.wav")) + list(OUTPUT_DIR.glob("*.mp3"))
+            files.sort(key=os.path.getmtime, reverse=True)
+            _audio_index["files"] = [str(p.resolve()) for p in files]
+            _audio_index["dir_mtime"] = dir_mtime
+        files = _audio_index["files"]
+        pending = [p for p in _pending_outputs
+                   if Path(p).parent == OUTPUT_DIR.resolve() and p not in files]
+        return sorted(pending) + files
+
+def track_output_path(track_name):
+    """Путь нового трека: повторная генерация под тем же названием получает версию _v2, _v3, ..."""
+    safe = create_safe_filename(track_name)
+    with _audio_index_lock:
+        pending = {Path(p).name for p in _pending_outputs}
+    path, version = OUTPUT_DIR / f"{safe}.wav", 1
+    while path.exists() or path.name in pending:
+        version += 1
+        path = OUTPUT_DIR / f"{safe}_v{version}.wav"
+    return path
+
+def unique_output_path(prefix, suffix=""):
+    """Уникальный путь результата, который не перезапишет соседний запрос: <prefix>_<дата>_<id><suffix>.wav"""
+    return OUTPUT_DIR / f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}{suffix}.wav"
 
 def list_voice_files():
     """Возвращает список полных путей к голосовым файлам"""
-    files = list(VOICE_DIR.glob("*.wav"))
+    # Обычно WAV; исходный формат остаётся, если голос не удалось сконвертировать
+    files = [p for ext in VOICE_EXTENSIONS for p in VOICE_DIR.glob(f"*{ext}")]
     files.sort(key=os.path.getmtime, reverse=True)
     return [str(f.resolve()) for f in files]
 
+def audio_duration(path_str: str):
+    """Длительность аудио файла в секундах: у WAV — по заголовку, без чтения данных"""
+    from wav_reader import audio_info, open_audio
+    info = audio_info(path_str)
+    if info is not None:
+        return info["duration"]
+    with open_audio(path_str) as audio:
+        return audio.duration
+
 def delete_file(path_str: str):
-    """Удаляет файл по пути"""
+    """Удаляет файл по пути; запись, ещё стоящая в очереди писателя, отменяется"""
     try:
-        if path_str and Path(path_str).exists():
+        if not path_str:
+            return True
+        from writebehind import writer
+        deleted = writer.discard(path_str)
+        if Path(path_str).exists():
             Path(path_str).unlink()
+            invalidate_audio_index()
+            deleted = True
+        if deleted:
             log(f"File deleted: {get_filename_only(path_str)}", Fore.YELLOW)
         return True
     except Exception as e:
@@ -60,28 +125,38 @@ def save_voice_to_voice_dir(src_path, custom_name=None):
     if not src_path or not os.path.isfile(src_path):
         raise Exception("Файл не найден")
     
-    ext = os.path.splitext(src_path)[1]
-    
     if custom_name:
         # Используем пользовательское название
-        safe_name = create_safe_filename(custom_name)
-        new_name = f"{safe_name}{ext}"
+        name_part = create_safe_filename(custom_name)
     else:
         # Используем случайное название
-        new_name = f"user_voice_{uuid.uuid4().hex[:8]}{ext}"
-    
-    dst_path = VOICE_DIR / new_name
+        name_part = f"user_voice_{uuid.uuid4().hex[:8]}"
     
-    # Проверяем, не существует ли уже файл с таким именем
-    counter = 1
-    original_dst_path = dst_path
-    while dst_path.exists():
-        name_part = original_dst_path.stem
-        dst_path = VOICE_DIR / f"{name_part}_{counter}{ext}"
-        counter += 1
+    def free_path(ext):
+        # Проверяем, не существует ли уже файл с таким именем
+        dst_path = VOICE_DIR / f"{name_part}{ext}"
+        counter = 1
+        while dst_path.exists():
+            dst_path = VOICE_DIR / f"{name_part}_{counter}{ext}"
+            counter += 1
+        return dst_path
     
     try:
-        shutil.copy(src_path, dst_path)
+        # Любой входной формат и частота приводятся к моно WAV VOICE_SAMPLE_RATE
+        dst_path = free_path(".wav")
+        try:
+            from audio_utils import audio_read, audio_write
+            from resample import resample
+            samples, sample_rate = audio_read(src_path, mono=True)
+            audio_write(str(dst_path), resample(samples[0], sample_rate, VOICE_SAMPLE_RATE), VOICE_SAMPLE_RATE,
+                        apply_export_rate=False)
+        except Exception as e:
+            # Не удалось декодировать — сохраняем как есть, с исходным расширением:
+            # mp3 под именем .wav не прочитать ни wav_reader, ни pydub
+            log(f"Voice conversion failed ({e}), saving original file", Fore.YELLOW)
+            dst_path.unlink(missing_ok=True)
+            dst_path = free_path(Path(src_path).suffix.lower() or ".wav")
+            shutil.copy(src_path, dst_path)
         log(f"Voice saved as: {dst_path.name}", Fore.GREEN)
         return str(dst_path)
     except Exception as e:
@@ -0,0 +1,169 @@
+"""
+Фоновые задания генерации для HTTP API.
+
+Задание получает id сразу после постановки в очередь, а сама генерация
+выполняется в пуле потоков через те же функции music_workflow.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import CancelToken, Cancelled
+from helpers import log
+from scheduler import QUEUE_CONCURRENCY
+from writebehind import writer
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+CANCELLED = "cancelled"
+
+# Потоки только ждут: сколько заданий реально выполняется, решает планировщик (scheduler.py)
+MAX_WORKERS = int(os.environ.get("LEON_JOB_WORKERS", str(QUEUE_CONCURRENCY)))
+MAX_HISTORY = 200
+
+
+class Job:
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = "В очереди"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Результат уже на диске (запись идёт в фоне после окончания генерации)
+        self.saved = False
+        self.cancel_token = CancelToken()
+        # Номер версии растёт при каждом изменении — по нему ждут SSE-подписчики
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def update(self, progress, message):
+        """progress_fn для функций music_workflow"""
+        with self._cond:
+            self.progress = float(progress)
+            self.message = message
+            self.version += 1
+            self._cond.notify_all()
+        return message
+
+    def _set(self, **fields):
+        with self._cond:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._cond.notify_all()
+
+    @property
+    def is_final(self):
+        return self.status in (DONE, ERROR, CANCELLED)
+
+    def wait_for_change(self, version, timeout=15.0):
+        """Блокирует до изменения задания (или таймаута), возвращает текущую версию"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or self.is_final, timeout)
+            return self.version
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "message": self.message,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "has_result": self.result is not None,
+            "results": len(self.result) if isinstance(self.result, list) else int(self.result is not None),
+            "saved": self.saved,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="leon-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, **params):
+        """Ставит fn(**params, progress_fn=..., cancel_token=...) в очередь и сразу возвращает Job"""
+        job = Job(kind, params)
+        with self._lock:
+            self._jobs[job.id] = job
+            # Из истории уходят только завершённые задания: идущие должны оставаться видны и отменяемы
+            excess = len(self._jobs) - MAX_HISTORY
+            if excess > 0:
+                for old_id in [i for i, j in self._jobs.items() if j.is_final][:excess]:
+                    del self._jobs[old_id]
+        self._pool.submit(self._run, job, fn)
+        log(f"[Jobs] {kind} job {job.id} queued")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def pending(self):
+        """Задания, ещё не взятые потоком пула"""
+        with self._lock:
+            return sum(job.status == QUEUED for job in self._jobs.values())
+
+    def cancel(self, job_id, reason="cancelled by user"):
+        """Просит задание остановиться; ещё не начатое завершится сразу при старте"""
+        job = self.get(job_id)
+        if job is None or job.is_final:
+            return job
+        job.cancel_token.cancel(reason)
+        job.update(job.progress, "⏹ Отмена...")
+        log(f"[Jobs] {job.kind} job {job.id} cancel requested")
+        return job
+
+    def _run(self, job, fn):
+        if job.cancel_token.cancelled:
+            job._set(status=CANCELLED, error=job.cancel_token.reason, finished=time.time())
+            return
+        job._set(status=RUNNING, started=time.time(), message="Запуск...")
+        try:
+            result = fn(**job.params, progress_fn=job.update, cancel_token=job.cancel_token)
+            # Несколько голосов возвращают список файлов
+            paths = result if isinstance(result, list) else [result]
+            tickets = [t for t in map(writer.ticket_for, paths) if t is not None]
+            job._set(status=DONE, result=result, progress=1.0, finished=time.time(), saved=not tickets)
+            for ticket in tickets:
+                ticket.add_done_callback(lambda t: self._on_saved(job, t, tickets))
+            log(f"[Jobs] {job.kind} job {job.id} done in {job.finished - job.started:.1f} sec.")
+        except Cancelled as e:
+            job._set(status=CANCELLED, error=str(e), finished=time.time())
+            log(f"[Jobs] {job.kind} job {job.id} cancelled")
+        except Exception as e:
+            job._set(status=ERROR, error=str(e), finished=time.time())
+            log(f"[Jobs] {job.kind} job {job.id} failed: {e}")
+
+    def _on_saved(self, job, ticket, tickets):
+        if ticket.error:
+            job._set(status=ERROR, error=f"Write failed: {ticket.error}")
+            log(f"[Jobs] {job.kind} job {job.id} result was not saved: {ticket.error}")
+        elif all(t.done for t in tickets):
+            job._set(saved=True)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+# Общий менеджер для API и интерфейса
+manager = JobManager()
@@ -0,0 +1,217 @@
+"""
+Нагрузочный тест интерфейса без GPU: имитирует одновременных пользователей
+поверх функций music_workflow с моделями-заглушками (stub_models.py).
+
+Очередь Gradio (demo.queue()) моделируется семафором на каждый обработчик
+(по умолчанию LEON_QUEUE_CONCURRENCY, как в main.py); дальше запросы ждут в
+планировщике (scheduler.py) — короткие первыми, с учётом пользователя. Время
+ожидания — сумма обеих очередей (ожидание в планировщике он сообщает сам), в
+service входит только работа. Так можно подобрать настройки параллелизма и
+планировщика офлайн.
+
+Примеры:
+    python loadtest.py --users 20 --duration 60
+    python loadtest.py --rate 0.5 --mix tts=5,music=3,song=2 --concurrency tts=2,music=1,song=1
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ENDPOINTS = ("tts", "music", "song")
+
+
+def parse_weights(text, default):
+    """'tts=5,music=3' -> {'tts': 5.0, 'music': 3.0, ...}"""
+    values = {name: default for name in ENDPOINTS}
+    if not text:
+        return values
+    if "=" not in text:
+        return {name: float(text) for name in ENDPOINTS}
+    for part in text.split(","):
+        name, _, value = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint: {name}")
+        values[name.strip()] = float(value)
+    return values
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_weights(args.mix, 1.0)
+        self.limits = {k: int(v) for k, v in parse_weights(args.concurrency, 1).items()}
+        self.queues = {k: threading.Semaphore(v) for k, v in self.limits.items()}
+        self.results = []
+        self._lock = threading.Lock()
+        self._counter = 0
+        # Запрос выполняется в своём потоке целиком — ожидание в планировщике копим там же
+        self._local = threading.local()
+
+        # Модели грузим только после того, как окружение настроено в main()
+        import music_workflow
+        from scheduler import scheduler
+        self.wf = music_workflow
+        scheduler.add_listener(self._on_slot)
+        self.voice = self._make_voice()
+
+    def _make_voice(self):
+        from helpers import VOICE_DIR
+        path = VOICE_DIR / "loadtest_voice.wav"
+        self.wf.tts.tts_to_file(text="voice reference " * 4, file_path=str(path))
+        return str(path)
+
+    def _on_slot(self, kind, user, waited):
+        if hasattr(self._local, "sched_wait"):
+            self._local.sched_wait += waited
+
+    def _pick(self):
+        names = list(self.mix)
+        return random.choices(names, weights=[self.mix[n] for n in names])[0]
+
+    def _call(self, kind, n, user):
+        a = self.args
+        if kind == "tts":
+            # Разные строки, чтобы кэш вокала не превращал тест в тест кэша
+            lyrics = " ".join(f"la{n}" for _ in range(random.randint(5, a.max_words)))
+            return self.wf.generate_tts_voice(lyrics, self.voice, user=user)
+        if kind == "music":
+            return self.wf.generate_music_workflow("lofi piano", random.randint(5, a.max_duration), f"load_{n}",
+                                                   user=user)
+        lyrics = " ".join(f"la{n}" for _ in range(random.randint(10, a.max_words)))
+        return self.wf.generate_song_with_voice(
+            lyrics, "pop", random.randint(10, a.max_duration), self.voice,
+            song_name=f"load_{n}", user=user,
+        )
+
+    def request(self, kind, user):
+        with self._lock:
+            self._counter += 1
+            n = self._counter
+        arrived = time.time()
+        with self.queues[kind]:
+            started = time.time()
+            error = None
+            self._local.sched_wait = 0.0
+            try:
+                self._call(kind, n, user)
+            except Exception as e:
+                error = str(e)
+            finished = time.time()
+            sched_wait = self._local.sched_wait
+            del self._local.sched_wait
+        with self._lock:
+            self.results.append({
+                "endpoint": kind, "arrived": arrived, "queue_wait": started - arrived + sched_wait,
+                "scheduler_wait": sched_wait, "service": finished - started - sched_wait,
+                "latency": finished - arrived, "error": error,
+            })
+
+    def run(self):
+        a = self.args
+        deadline = time.time() + a.duration
+        threads = []
+        if a.rate:
+            # Открытая модель: пуассоновский поток запросов
+            while time.time() < deadline:
+                user = f"user{random.randrange(max(a.users, 1))}"
+                t = threading.Thread(target=self.request, args=(self._pick(), user), daemon=True)
+                t.start()
+                threads.append(t)
+                time.sleep(random.expovariate(a.rate))
+        else:
+            # Закрытая модель: N пользователей, каждый ждёт ответа и «думает»
+            def user(name):
+                while time.time() < deadline:
+                    self.request(self._pick(), name)
+                    time.sleep(random.expovariate(1 / a.think_time) if a.think_time > 0 else 0)
+            threads = [threading.Thread(target=user, args=(f"user{i}",), daemon=True) for i in range(a.users)]
+            for t in threads:
+                t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.time() - (deadline - a.duration))
+
+    def report(self, elapsed):
+        report = {"elapsed": elapsed, "concurrency": self.limits, "endpoints": {}}
+        for kind in ENDPOINTS:
+            rows = [r for r in self.results if r["endpoint"] == kind]
+            if not rows:
+                continue
+            ok = [r for r in rows if not r["error"]]
+            report["endpoints"][kind] = {
+                "requests": len(rows),
+                "errors": len(rows) - len(ok),
+                "error_rate": (len(rows) - len(ok)) / len(rows),
+                "throughput_rps": len(ok) / elapsed,
+                **{f"queue_wait_p{q}": percentile([r["queue_wait"] for r in rows], q) for q in (50, 95, 99)},
+                "scheduler_wait_p50": percentile([r["scheduler_wait"] for r in rows], 50),
+                "service_p50": percentile([r["service"] for r in ok], 50),
+                **{f"latency_p{q}": percentile([r["latency"] for r in ok], q) for q in (50, 95, 99)},
+                "sample_errors": sorted({r["error"] for r in rows if r["error"]})[:3],
+            }
+        return report
+
+
+def print_report(report):
+    print(f"\nElapsed {report['elapsed']:.1f}s, concurrency {report['concurrency']}")
+    header = f"{'endpoint':<8} {'reqs':>5} {'err%':>6} {'rps':>7} " \
+             f"{'wait50':>7} {'wait95':>7} {'wait99':>7} {'lat50':>7} {'lat95':>7} {'lat99':>7}"
+    print(header)
+    print("-" * len(header))
+    for kind, r in report["endpoints"].items():
+        print(f"{kind:<8} {r['requests']:>5} {r['error_rate']*100:>5.1f}% {r['throughput_rps']:>7.3f} "
+              f"{r['queue_wait_p50']:>7.2f} {r['queue_wait_p95']:>7.2f} {r['queue_wait_p99']:>7.2f} "
+              f"{r['latency_p50']:>7.2f} {r['latency_p95']:>7.2f} {r['latency_p99']:>7.2f}")
+        for err in r["sample_errors"]:
+            print(f"         ! {err}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the workflow layer with stub models")
+    parser.add_argument("--users", type=int, default=20, help="simulated users (closed loop)")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second (open loop, overrides --users)")
+    parser.add_argument("--think-time", type=float, default=5.0, help="mean pause between a user's requests, s")
+    parser.add_argument("--duration", type=float, default=60.0, help="test duration, s")
+    parser.add_argument("--mix", default="tts=5,music=3,song=2", help="request mix weights")
+    parser.add_argument("--concurrency", default=os.environ.get("LEON_QUEUE_CONCURRENCY", "8"),
+                        help="per-endpoint Gradio concurrency limit, e.g. 'tts=2,music=1'")
+    parser.add_argument("--latency-scale", type=float, default=0.05,
+                        help="stub latency multiplier (1.0 ~ real CPU timings)")
+    parser.add_argument("--max-duration", type=int, default=60, help="max requested audio duration, s")
+    parser.add_argument("--max-words", type=int, default=60, help="max lyrics length, words")
+    parser.add_argument("--workdir", help="where to write outputs (default: temp dir)")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    # Окружение — до импорта music_workflow: заглушки вместо моделей и отдельная папка для файлов
+    os.environ["LEON_STUB_MODELS"] = "1"
+    os.environ["LEON_STUB_LATENCY"] = str(args.latency_scale)
+    json_path = Path(args.json).resolve() if args.json else None
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="leon_load_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    os.chdir(workdir)
+
+    report = LoadTest(args).run()
+    print_report(report)
+    if json_path:
+        json_path.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
+import time
+from contextlib import contextmanager
+from pathlib import Path
 import gradio as gr
 from helpers import (
-    log, list_audio_files, list_voice_files, delete_file, save_voice_to_voice_dir, get_filename_only
+    log, list_audio_files, list_voice_files, delete_file, save_voice_to_voice_dir, get_filename_only,
+    audio_duration
 )
 
 # Показываем статус загрузки моделей
@@ -8,8 +12,16 @@ log("🚀 Starting Leon Vibe Creator...")
 log("📦 Loading AI models... (this may take 10-15 seconds)")
 
 from music_workflow import (
-    generate_music_workflow, generate_song_with_voice, generate_tts_voice
+    generate_music_workflow, generate_song_with_voice, generate_tts_voice,
+    generate_music_draft, refine_music_workflow, stream_music_workflow, generate_multi_voice,
+    MULTI_VOICE_MODES, MUSICGEN_TIERS
 )
+from jobs import CANCELLED, DONE, ERROR, manager as job_manager
+from projects import list_projects, load_mix, remix_project
+from retention import format_report, start_sweeper, sweep, toggle_pin
+from writebehind import ui_audio, writer
+from scheduler import QUEUE_CONCURRENCY
+from cancellation import Cancelled, registry as cancel_registry
 
 log("🎉 All models loaded! Ready to create music!")
 
@@ -35,10 +47,28 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
                 track_name_input = gr.Textbox(label="Track name", value="Leon_music", elem_classes="square-textbox")
                 duration_input = gr.Slider(minimum=5, maximum=60, value=20, step=1, label="Duration (sec)")
         
-        generate_button = gr.Button("🎵 Generate Track", variant="primary", size="lg")
+        with gr.Row():
+            generate_button = gr.Button("🎵 Generate Track", variant="primary", size="lg")
+            stream_button = gr.Button("🎧 Generate with live preview", variant="secondary", size="lg")
+            stop_button = gr.Button("⏹ Stop", variant="stop", size="lg")
         
         status_generate = gr.Textbox(label="Status", value="Ready to generate", interactive=False)
+        preview_audio_output = gr.Audio(label="Live preview", streaming=True, autoplay=True, visible=False)
         generated_audio_output = gr.Audio(label="Generated Track", type="filepath")
+        
+        with gr.Accordion("⚡ Draft → Final", open=False):
+            gr.Markdown(
+                f"*Быстрый черновик на `{MUSICGEN_TIERS['draft']}`, затем финальная версия "
+                f"на `{MUSICGEN_TIERS['final']}` в фоне — черновик становится её началом.*"
+            )
+            with gr.Row():
+                draft_button = gr.Button("⚡ Draft", variant="secondary")
+                accept_draft_button = gr.Button("✅ Accept & render final", variant="primary")
+                check_final_button = gr.Button("🔄 Check final", variant="secondary")
+            draft_audio_output = gr.Audio(label="Draft", type="filepath")
+            status_final = gr.Textbox(label="Final render", value="Нет черновика", interactive=False)
+            final_audio_output = gr.Audio(label="Final Track", type="filepath")
+            final_job_id = gr.State(None)
 
     with gr.Tab("File Manager"):
         gr.Markdown("### 📂 Manage your files")
@@ -56,8 +86,15 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
         
         with gr.Row():
             play_button = gr.Button("▶️ Play", variant="secondary")
+            pin_button = gr.Button("📌 Pin / Unpin", variant="secondary")
             delete_button = gr.Button("🗑️ Delete", variant="stop")
         audio_player = gr.Audio(label="🎵 Player", type="filepath")
+        
+        with gr.Accordion("🧹 Cleanup", open=False):
+            with gr.Row():
+                cleanup_preview_button = gr.Button("🔍 Preview cleanup", variant="secondary")
+                cleanup_button = gr.Button("🧹 Clean up now", variant="stop")
+            cleanup_report = gr.Textbox(label="Report", lines=6, interactive=False)
 
     with gr.Tab("Record Voice"):
         gr.Markdown("### 🎤 Записать ваш голос")
@@ -116,9 +153,16 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
         gr.Markdown("---")
         gr.Markdown("### 📚 Ваши сохраненные голоса")
         
+        def voice_label(path):
+            """Имя голоса и длина референса — её видно по заголовку WAV, файл не читается"""
+            try:
+                return f"{get_filename_only(path)} ({audio_duration(path):.0f}с)"
+            except Exception:
+                return get_filename_only(path)
+        
         def get_voice_files_display():
             files = list_voice_files()
-            return [(get_filename_only(f), f) for f in files]
+            return [(voice_label(f), f) for f in files]
         
         saved_voices_list = gr.Dropdown(
             label="🎤 Сохраненные голоса",
@@ -149,10 +193,27 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
             max_lines=10
         )
         
-        generate_tts_btn = gr.Button("🎤 Синтезировать", variant="primary", size="lg")
+        with gr.Row():
+            generate_tts_btn = gr.Button("🎤 Синтезировать", variant="primary", size="lg")
+            stop_tts_btn = gr.Button("⏹ Стоп", variant="stop", size="lg")
         
         status_tts = gr.Textbox(label="🎙️ Статус", value="Выберите голос и введите текст", interactive=False)
         tts_result_audio = gr.Audio(label="🔊 Результат", type="filepath")
+        
+        with gr.Accordion("👥 Несколько голосов", open=False):
+            gr.Markdown("*Тот же текст сразу несколькими голосами: стемы для сравнения или дуэт "
+                        "(строки по очереди, припев вместе).*")
+            multi_voice_selector = gr.Dropdown(
+                label="🎤 Голоса (от двух)",
+                choices=get_voice_files_display(),
+                multiselect=True,
+                interactive=True
+            )
+            multi_mode_input = gr.Radio(list(MULTI_VOICE_MODES), value="stems", label="🎼 Режим")
+            generate_multi_btn = gr.Button("👥 Синтезировать голосами", variant="primary")
+            status_multi = gr.Textbox(label="🎙️ Статус", interactive=False)
+            multi_result_audio = gr.Audio(label="🔊 Основной результат", type="filepath")
+            multi_result_files = gr.File(label="📁 Все файлы", file_count="multiple")
 
     with gr.Tab("Complete Song"):
         gr.Markdown("### 🎵 Создать песню с голосом")
@@ -184,10 +245,25 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
                 label="⏱️ Длительность (сек)"
             )
         
-        generate_song_btn = gr.Button("🎬 Создать песню", variant="primary", size="lg")
+        with gr.Row():
+            generate_song_btn = gr.Button("🎬 Создать песню", variant="primary", size="lg")
+            stop_song_btn = gr.Button("⏹ Стоп", variant="stop", size="lg")
         
         status_song = gr.Textbox(label="🎼 Статус", value="Выберите голос и введите текст", interactive=False)
         song_output = gr.Audio(label="🎊 Готовая песня", type="filepath")
+        
+        with gr.Accordion("🎚️ Ремикс", open=False):
+            gr.Markdown("*Пересобирает только сведение из сохранённых стемов — модели заново не запускаются.*")
+            project_selector = gr.Dropdown(label="📁 Проект", choices=list_projects(), interactive=True)
+            with gr.Row():
+                vocal_gain_input = gr.Slider(minimum=-20, maximum=10, value=0, step=0.5, label="🎤 Громкость вокала (dB)")
+                music_gain_input = gr.Slider(minimum=-20, maximum=10, value=0, step=0.5, label="🎸 Громкость музыки (dB)")
+                vocal_offset_input = gr.Slider(minimum=-2000, maximum=5000, value=0, step=50, label="⏩ Сдвиг вокала (мс)")
+            with gr.Row():
+                fade_in_input = gr.Slider(minimum=0, maximum=5000, value=0, step=100, label="Fade in (мс)")
+                fade_out_input = gr.Slider(minimum=0, maximum=5000, value=0, step=100, label="Fade out (мс)")
+                normalize_input = gr.Checkbox(label="Нормализовать", value=False)
+            remix_btn = gr.Button("🎚️ Пересвести", variant="primary")
 
     # === ФУНКЦИИ ОБРАБОТКИ ===
     
@@ -236,23 +312,119 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
         except Exception as e:
             return f"❌ Ошибка сохранения: {str(e)}", gr.update(), gr.update()
     
+    def session_user(request):
+        """Сессия браузера — пользователь для справедливой очереди планировщика"""
+        return getattr(request, "session_hash", None)
+
+    @contextmanager
+    def session_token(request, kind):
+        """Токен отмены генерации сессии на вкладке kind: его отменяют Stop этой вкладки и закрытие вкладки"""
+        owner = (session_user(request), kind)
+        token = cancel_registry.open(owner)
+        try:
+            yield token
+        finally:
+            cancel_registry.close(owner, token)
+
+    def on_stop(kind, request):
+        count = cancel_registry.cancel((session_user(request), kind))
+        return "⏹ Останавливаем генерацию..." if count else "Нет активной генерации"
+
+    def on_stop_track(job_id, request: gr.Request):
+        """Stop на вкладке трека останавливает и фоновый финальный рендер"""
+        job = job_manager.cancel(job_id) if job_id else None
+        status = on_stop("music", request)
+        if job is not None and not job.is_final:
+            status = "⏹ Останавливаем генерацию..."
+        return status
+
+    def on_session_end(request: gr.Request):
+        """Вкладку закрыли — её генерации никому не нужны"""
+        count = cancel_registry.cancel_session(session_user(request), "browser tab closed")
+        if count:
+            log(f"[Cancel] Session closed, {count} generation(s) cancelled")
+
     # Функции для основного функционала
-    def on_generate_and_update(prompt, duration, track_name, progress=gr.Progress()):
+    def on_generate_and_update(prompt, duration, track_name, request: gr.Request, progress=gr.Progress()):
         try:
             def update_status(percent, desc):
                 progress(percent, desc=desc)
                 return desc
                 
-            result = generate_music_workflow(prompt, duration, track_name, update_status)
+            with session_token(request, "music") as token:
+                result = generate_music_workflow(prompt, duration, track_name, update_status,
+                                                 user=session_user(request), cancel_token=token)
             
             # Обновляем список файлов
             new_choices = get_audio_files_display()
             
-            return result, gr.update(choices=new_choices), "✅ Трек создан!"
+            return ui_audio(result), gr.update(choices=new_choices), "✅ Трек создан!"
+        except Cancelled:
+            return None, gr.update(), "⏹ Генерация остановлена"
         except Exception as e:
             return None, gr.update(), f"❌ Ошибка: {str(e)}"
 
-    def on_generate_tts(lyrics, voice_path, progress=gr.Progress()):
+    def on_generate_stream(prompt, duration, track_name, request: gr.Request):
+        """Отдаёт кусочки превью в потоковый плеер, в конце — готовый файл"""
+        status = {"text": "🎵 Генерация..."}
+        def update_status(percent, desc):
+            status["text"] = desc
+            return desc
+        
+        yield gr.update(visible=True, value=None), None, gr.update(), status["text"]
+        try:
+            with session_token(request, "music") as token:
+                for kind, payload in stream_music_workflow(prompt, duration, track_name, update_status,
+                                                           user=session_user(request), cancel_token=token):
+                    if kind == "preview":
+                        sample_rate, samples = payload
+                        chunk = (samples * 32767).clip(-32768, 32767).astype("int16")
+                        yield (sample_rate, chunk), None, gr.update(), status["text"]
+                    else:
+                        yield gr.update(), ui_audio(payload), refresh_audio_files(), "✅ Трек создан!"
+        except Cancelled:
+            yield gr.update(), None, gr.update(), "⏹ Генерация остановлена"
+        except Exception as e:
+            yield gr.update(), None, gr.update(), f"❌ Ошибка: {str(e)}"
+
+    def on_generate_draft(prompt, track_name, request: gr.Request, progress=gr.Progress()):
+        try:
+            def update_status(percent, desc):
+                progress(percent, desc=desc)
+                return desc
+                
+            with session_token(request, "music") as token:
+                result = generate_music_draft(prompt, track_name, update_status,
+                                              user=session_user(request), cancel_token=token)
+            return ui_audio(result), "⚡ Черновик готов! Нажмите «Accept», чтобы отрендерить финал"
+        except Cancelled:
+            return None, "⏹ Черновик остановлен"
+        except Exception as e:
+            return None, f"❌ Ошибка: {str(e)}"
+
+    def on_accept_draft(draft_path, prompt, duration, track_name, request: gr.Request):
+        if not draft_path:
+            return None, "❌ Сначала создайте черновик"
+        job = job_manager.submit(
+            "refine", refine_music_workflow,
+            draft_path=draft_path, prompt=prompt, duration=duration, track_name=track_name,
+            user=session_user(request),
+        )
+        return job.id, "🎼 Финальный рендер запущен в фоне..."
+
+    def on_check_final(job_id):
+        job = job_manager.get(job_id) if job_id else None
+        if job is None:
+            return None, "Финальный рендер не запущен", gr.update()
+        if job.status == DONE:
+            return ui_audio(job.result), "✅ Финальная версия готова!", refresh_audio_files()
+        if job.status == ERROR:
+            return None, f"❌ Ошибка: {job.error}", gr.update()
+        if job.status == CANCELLED:
+            return None, "⏹ Финальный рендер остановлен", gr.update()
+        return None, f"{job.message} ({job.progress*100:.0f}%)", gr.update()
+
+    def on_generate_tts(lyrics, voice_path, request: gr.Request, progress=gr.Progress()):
         try:
             if not lyrics.strip():
                 return None, "❌ Введите текст"
@@ -263,24 +435,79 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
                 progress(percent, desc=desc)
                 return desc
                 
-            result = generate_tts_voice(lyrics, voice_path, update_status)
-            return result, "✅ Голос синтезирован!"
+            with session_token(request, "tts") as token:
+                result = generate_tts_voice(lyrics, voice_path, update_status,
+                                            user=session_user(request), cancel_token=token)
+            return ui_audio(result), "✅ Голос синтезирован!"
+        except Cancelled:
+            return None, "⏹ Синтез остановлен"
         except Exception as e:
             return None, f"❌ Ошибка: {str(e)}"
 
-    def on_generate_song(lyrics, genre, duration, voice_path, progress=gr.Progress()):
+    def on_generate_multi_voice(lyrics, voice_paths, mode, request: gr.Request, progress=gr.Progress()):
         try:
             if not lyrics.strip():
-                return None, "❌ Введите текст песни"
+                return None, None, "❌ Введите текст"
+            if not voice_paths or len(voice_paths) < 2:
+                return None, None, "❌ Выберите хотя бы два голоса"
+                
+            def update_status(percent, desc):
+                progress(percent, desc=desc)
+                return desc
+                
+            with session_token(request, "tts") as token:
+                results = generate_multi_voice(lyrics, voice_paths, mode, update_status,
+                                               user=session_user(request), cancel_token=token)
+            # gr.File отдаёт файлы сразу — дожидаемся записи всех стемов
+            for path in results:
+                writer.wait_for(path)
+            return ui_audio(results[0]), results, f"✅ Готово: {len(results)} файлов"
+        except Cancelled:
+            return None, None, "⏹ Синтез остановлен"
+        except Exception as e:
+            return None, None, f"❌ Ошибка: {str(e)}"
+
+    def on_generate_song(lyrics, genre, duration, voice_path, request: gr.Request, progress=gr.Progress()):
+        try:
+            if not lyrics.strip():
+                return None, "❌ Введите текст песни", gr.update()
             if not voice_path:
-                return None, "❌ Выберите голос"
+                return None, "❌ Выберите голос", gr.update()
                 
             def update_status(percent, desc):
                 progress(percent, desc=desc)
                 return desc
                 
-            result = generate_song_with_voice(lyrics, genre, duration, voice_path, update_status)
-            return result, "✅ Песня создана!"
+            with session_token(request, "song") as token:
+                result = generate_song_with_voice(lyrics, genre, duration, voice_path, update_status,
+                                                  user=session_user(request), cancel_token=token)
+            project = Path(result).stem
+            return ui_audio(result), "✅ Песня создана!", gr.update(choices=list_projects(), value=project)
+        except Cancelled:
+            return None, "⏹ Создание песни остановлено", gr.update()
+        except Exception as e:
+            return None, f"❌ Ошибка: {str(e)}", gr.update()
+
+    def on_select_project(project):
+        """Подставляет текущие параметры сведения проекта в ползунки"""
+        if not project:
+            return [gr.update()] * 6
+        mix = load_mix(project)
+        vocal, music, master = mix["tracks"]["vocal"], mix["tracks"]["music"], mix["master"]
+        normalized = any(e.get("type") == "normalize" for e in master["effects"])
+        return (vocal["gain_db"], music["gain_db"], vocal["offset_ms"],
+                master["fade_in_ms"], master["fade_out_ms"], normalized)
+
+    def on_remix(project, vocal_gain, music_gain, vocal_offset, fade_in, fade_out, normalize):
+        if not project:
+            return None, "❌ Выберите проект"
+        try:
+            t0 = time.time()
+            result = remix_project(
+                project, vocal_gain_db=vocal_gain, music_gain_db=music_gain, vocal_offset_ms=vocal_offset,
+                fade_in_ms=fade_in, fade_out_ms=fade_out, normalize=normalize,
+            )
+            return ui_audio(result), f"✅ Пересведено за {(time.time() - t0) * 1000:.0f} мс"
         except Exception as e:
             return None, f"❌ Ошибка: {str(e)}"
 
@@ -291,7 +518,8 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
         return (
             gr.update(choices=new_choices),  # saved_voices_list
             gr.update(choices=new_choices),  # voice_selector
-            gr.update(choices=new_choices)   # voice_selector_song
+            gr.update(choices=new_choices),  # voice_selector_song
+            gr.update(choices=new_choices)   # multi_voice_selector
         )
     
     def refresh_audio_files():
@@ -305,6 +533,17 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
             delete_file(filepath)
         return refresh_audio_files()
 
+    def on_toggle_pin(filepath):
+        """Закрепляет файл, чтобы очистка его не трогала"""
+        if not filepath:
+            return "❌ Выберите файл"
+        pinned = toggle_pin(filepath)
+        return f"📌 {get_filename_only(filepath)} закреплён" if pinned else f"{get_filename_only(filepath)} откреплён"
+
+    def on_cleanup(dry_run):
+        report = sweep(dry_run=dry_run)
+        return format_report(report), refresh_audio_files()
+
     def on_delete_voice_file(filepath):
         """Удаляет файл голоса"""
         if filepath:
@@ -335,7 +574,7 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
     # Управление голосами
     refresh_voices_btn.click(
         refresh_voice_lists,
-        outputs=[saved_voices_list, voice_selector, voice_selector_song]
+        outputs=[saved_voices_list, voice_selector, voice_selector_song, multi_voice_selector]
     )
     
     play_saved_voice_btn.click(
@@ -347,31 +586,97 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
     delete_voice_btn.click(
         on_delete_voice_file,
         inputs=[saved_voices_list],
-        outputs=[saved_voices_list, voice_selector, voice_selector_song]
+        outputs=[saved_voices_list, voice_selector, voice_selector_song, multi_voice_selector]
     )
     
     # Основной функционал
-    generate_button.click(
+    generate_event = generate_button.click(
         on_generate_and_update,
         inputs=[prompt_input, duration_input, track_name_input],
         outputs=[generated_audio_output, files_list_manage, status_generate]
     )
     
-    generate_tts_btn.click(
+    stream_event = stream_button.click(
+        on_generate_stream,
+        inputs=[prompt_input, duration_input, track_name_input],
+        outputs=[preview_audio_output, generated_audio_output, files_list_manage, status_generate]
+    )
+    
+    draft_event = draft_button.click(
+        on_generate_draft,
+        inputs=[prompt_input, track_name_input],
+        outputs=[draft_audio_output, status_final]
+    )
+    
+    accept_draft_button.click(
+        on_accept_draft,
+        inputs=[draft_audio_output, prompt_input, duration_input, track_name_input],
+        outputs=[final_job_id, status_final]
+    )
+    
+    check_final_button.click(
+        on_check_final,
+        inputs=[final_job_id],
+        outputs=[final_audio_output, status_final, files_list_manage]
+    )
+    
+    tts_event = generate_tts_btn.click(
         on_generate_tts,
         inputs=[lyrics_input, voice_selector],
         outputs=[tts_result_audio, status_tts]
     )
     
-    generate_song_btn.click(
+    multi_event = generate_multi_btn.click(
+        on_generate_multi_voice,
+        inputs=[lyrics_input, multi_voice_selector, multi_mode_input],
+        outputs=[multi_result_audio, multi_result_files, status_multi]
+    )
+    
+    song_event = generate_song_btn.click(
         on_generate_song,
         inputs=[lyrics_song_input, genre_input, duration_input2, voice_selector_song],
+        outputs=[song_output, status_song, project_selector]
+    )
+    
+    # Stop: токены останавливают модели, cancels — обработчики Gradio
+    stop_button.click(
+        on_stop_track,
+        inputs=[final_job_id],
+        outputs=[status_generate],
+        cancels=[generate_event, stream_event, draft_event]
+    )
+    
+    def on_stop_tts(request: gr.Request):
+        return on_stop("tts", request)
+
+    def on_stop_song(request: gr.Request):
+        return on_stop("song", request)
+
+    stop_tts_btn.click(on_stop_tts, outputs=[status_tts], cancels=[tts_event, multi_event])
+    
+    stop_song_btn.click(on_stop_song, outputs=[status_song], cancels=[song_event])
+    
+    # Закрытие вкладки (Gradio 4.x с Blocks.unload)
+    if hasattr(demo, "unload"):
+        demo.unload(on_session_end)
+    
+    project_selector.change(
+        on_select_project,
+        inputs=[project_selector],
+        outputs=[vocal_gain_input, music_gain_input, vocal_offset_input, fade_in_input, fade_out_input, normalize_input]
+    )
+    
+    remix_btn.click(
+        on_remix,
+        inputs=[project_selector, vocal_gain_input, music_gain_input, vocal_offset_input,
+                fade_in_input, fade_out_input, normalize_input],
         outputs=[song_output, status_song]
     )
     
     # Управление файлами
     play_button.click(
-        lambda p: p, 
+        # Файл может ещё писаться в фоне — тогда играем из памяти
+        lambda p: ui_audio(p) if p else None, 
         inputs=[files_list_manage], 
         outputs=[audio_player]
     )
@@ -381,8 +686,32 @@ with gr.Blocks(theme=gr.themes.Monochrome(), css=".square-textbox textarea { asp
         inputs=[files_list_manage],
         outputs=[files_list_manage]
     )
+    
+    pin_button.click(
+        on_toggle_pin,
+        inputs=[files_list_manage],
+        outputs=[cleanup_report]
+    )
+    
+    cleanup_preview_button.click(
+        lambda: on_cleanup(True),
+        outputs=[cleanup_report, files_list_manage]
+    )
+    
+    cleanup_button.click(
+        lambda: on_cleanup(False),
+        outputs=[cleanup_report, files_list_manage]
+    )
 
 if __name__ == "__main__":
+    import uvicorn
+    from api import create_api_app
+
     log("===> Interface loaded! Open in browser: http://127.0.0.1:7860")
-    demo.queue()
-    demo.launch()
\ No newline at end of file
+    log("===> HTTP API: http://127.0.0.1:7860/api (docs: /docs)")
+    start_sweeper()
+    # Генерации ждут своей очереди в планировщике (scheduler.py), а не в FIFO Gradio
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY)
+    # API и интерфейс на одном сервере: /api/* — задания, / — Gradio
+    app = gr.mount_gradio_app(create_api_app(), demo, path="/")
+    uvicorn.run(app, host="127.0.0.1", port=7860)
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+Синтез одного текста несколькими голосами: дуэты и сравнение голосов.
+
+Текст разбирается один раз (vocal_cache), а каждая строка синтезируется сразу
+всеми голосами: у XTTS латенты условия голосов складываются в батч, и GPT
+генерирует коды для всех дикторов за один проход (общий текст — одинаковая
+длина префикса). Коды обрезаются по стоп-токену каждого диктора, латенты GPT
+считаются одним батчем, а HiFi-GAN декодирует каждого диктора отдельно — длины
+разные. Если модель не XTTS (или внутренности отличаются), голоса синтезируются
+по очереди через tts.tts().
+
+Одиночный синтез (synthesize) тоже идёт через кэш латентов: tts.tts(speaker_wav=...)
+пересчитывает их из референса при каждом вызове, а песня синтезируется по строкам.
+"""
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from helpers import log
+from vocal_cache import assemble
+
+# Ошибки, означающие, что внутренности модели не те (нет атрибута, другая сигнатура, нет torch):
+# повторять бессмысленно. Остальные (длинная строка, нехватка памяти GPU) — сбой одного вызова
+STRUCTURAL_ERRORS = (AttributeError, TypeError, ImportError)
+
+
+class BatchedXTTS:
+    def __init__(self, tts):
+        self.tts = tts
+        synthesizer = getattr(tts, "synthesizer", None)
+        model = getattr(synthesizer, "tts_model", None)
+        # Нужны внутренности Xtts из TTS 0.22: GPT с generate/forward и HiFi-GAN декодер
+        self.model = model if all(hasattr(model, a) for a in ("gpt", "hifigan_decoder", "get_conditioning_latents")) else None
+        self._latents = {}
+        self._lock = threading.Lock()
+        self.batched = self.model is not None
+
+    def _conditioning(self, voice_path):
+        """Латенты голоса кэшируются по (путь, mtime) — референс читается один раз"""
+        path = Path(voice_path).resolve()
+        key = (str(path), path.stat().st_mtime_ns)
+        with self._lock:
+            if key not in self._latents:
+                cfg = self.model.config
+                self._latents[key] = self.model.get_conditioning_latents(
+                    audio_path=[str(path)],
+                    gpt_cond_len=cfg.gpt_cond_len,
+                    gpt_cond_chunk_len=cfg.gpt_cond_chunk_len,
+                    max_ref_length=cfg.max_ref_len,
+                    sound_norm_refs=cfg.sound_norm_refs,
+                )
+            return self._latents[key]
+
+    def synthesize(self, text, speaker_wav, language="en"):
+        """Как tts.tts(text=, speaker_wav=, language=), но латенты голоса считаются один раз"""
+        if self.model is not None:
+            try:
+                cfg = self.model.config
+                gpt_cond_latent, speaker_embedding = self._conditioning(speaker_wav)
+                out = self.model.inference(
+                    text, language.split("-")[0], gpt_cond_latent, speaker_embedding,
+                    temperature=cfg.temperature,
+                    length_penalty=cfg.length_penalty,
+                    repetition_penalty=cfg.repetition_penalty,
+                    top_k=cfg.top_k,
+                    top_p=cfg.top_p,
+                    enable_text_splitting=True,
+                )
+                wav = out["wav"]
+                return np.asarray(wav.cpu().numpy() if hasattr(wav, "cpu") else wav, dtype=np.float32).squeeze()
+            except STRUCTURAL_ERRORS as e:
+                log(f"[MultiVoice] XTTS inference with cached latents is not supported ({e}), using tts.tts()")
+                self.model = None
+                self.batched = False
+            except Exception as e:
+                log(f"[MultiVoice] XTTS inference with cached latents failed for this line ({e}), using tts.tts()")
+        return np.asarray(self.tts.tts(text=text, speaker_wav=speaker_wav, language=language), dtype=np.float32)
+
+    def _sequential(self, text, voices, language):
+        return [self.synthesize(text, v, language) for v in voices]
+
+    def _batch(self, text, voices, language):
+        import torch
+
+        model, cfg = self.model, self.model.config
+        gpt = model.gpt
+        device = model.device
+        conds = [self._conditioning(v) for v in voices]
+        cond_latents = torch.cat([c[0] for c in conds]).to(device)
+        speakers = torch.cat([c[1] for c in conds]).to(device)
+        lang = language.split("-")[0]
+        tokens = torch.IntTensor(model.tokenizer.encode(text.strip().lower(), lang=lang)).unsqueeze(0).to(device)
+        if tokens.shape[-1] >= model.args.gpt_max_text_tokens:
+            raise ValueError("line is too long for one XTTS pass")
+        tokens = tokens.repeat(len(voices), 1)
+
+        with torch.inference_mode():
+            codes = gpt.generate(
+                cond_latents=cond_latents,
+                text_inputs=tokens,
+                input_tokens=None,
+                do_sample=True,
+                top_p=cfg.top_p,
+                top_k=cfg.top_k,
+                temperature=cfg.temperature,
+                num_return_sequences=1,
+                num_beams=1,
+                length_penalty=cfg.length_penalty,
+                repetition_penalty=cfg.repetition_penalty,
+                output_attentions=False,
+            )
+            # Закончившие раньше строки добиты стоп-токеном; длина — до первого стопа включительно,
+            # как у одиночного inference
+            lengths = []
+            for row in codes:
+                stops = (row == gpt.stop_audio_token).nonzero()
+                lengths.append(int(stops[0]) + 1 if len(stops) else row.shape[-1])
+            code_lens = torch.tensor(lengths, device=device)
+            text_lens = torch.full((len(voices),), tokens.shape[-1], device=device)
+            latents = gpt(
+                tokens, text_lens, codes, code_lens * gpt.code_stride_len,
+                cond_latents=cond_latents, return_attentions=False, return_latent=True,
+            )
+            # Латенты короче кодов на постоянную величину (служебные токены)
+            trim = codes.shape[-1] - latents.shape[1]
+            wavs = []
+            for i, n in enumerate(lengths):
+                wav = model.hifigan_decoder(latents[i:i + 1, :n - trim], g=speakers[i:i + 1])
+                wavs.append(wav.cpu().squeeze().numpy().astype(np.float32))
+        return wavs
+
+    def __call__(self, text, voices, language="en"):
+        """Сэмплы строки text для каждого голоса из voices (в том же порядке)"""
+        if self.batched and len(voices) > 1:
+            try:
+                return self._batch(text, voices, language)
+            except STRUCTURAL_ERRORS as e:
+                log(f"[MultiVoice] Batched XTTS is not supported by this model ({e}), switching to sequential synthesis")
+                self.batched = False
+            except Exception as e:
+                log(f"[MultiVoice] Batched XTTS failed for this line ({e}), synthesizing voices one by one")
+        return self._sequential(text, voices, language)
+
+
+def arrange_duet(keys, segments, sample_rate, gap_ms, crossfade_ms):
+    """
+    Дуэт из сегментов всех голосов: строки по очереди, а повторяющиеся строки
+    (припев) — всеми голосами вместе.
+    """
+    voices = list(segments)
+    repeated = {k for k in keys if keys.count(k) > 1}
+    arranged, solo = [], 0
+    for i, key in enumerate(keys):
+        if key in repeated:
+            parts = [segments[v][i] for v in voices]
+            mix = np.zeros(max(len(p) for p in parts), dtype=np.float32)
+            for p in parts:
+                mix[:len(p)] += p
+            arranged.append(mix / np.float32(np.sqrt(len(parts))))
+        else:
+            arranged.append(segments[voices[solo % len(voices)]][i])
+            solo += 1
+    return assemble(arranged, sample_rate, gap_ms, crossfade_ms)
@@ -0,0 +1,101 @@
+"""
+Промежуточное прослушивание MusicGen во время генерации.
+
+TokenTap перехватывает токены, которые LM выбирает на каждом шаге, и по запросу
+декодирует уже готовый префикс через EnCodec (compression_model.decode).
+MusicGen пишет кодбуки с задержкой (delay pattern): на шаге s кодбук k
+получает токен для момента времени s - delay[k], поэтому момент t полностью
+готов, когда сделан шаг t + max(delay).
+
+Если у модели нет нужных атрибутов (другая версия audiocraft, заглушка) —
+TokenTap.supported == False и генерация идёт без превью.
+"""
+import threading
+from contextlib import contextmanager
+
+from helpers import log
+
+# Перехват ставится на общий экземпляр модели, поэтому одновременно — только один
+_tap_lock = threading.Lock()
+
+
+class TokenTap:
+    def __init__(self, model):
+        self.model = model
+        self.lm = getattr(model, "lm", None)
+        provider = getattr(self.lm, "pattern_provider", None)
+        self.delays = list(getattr(provider, "delays", []) or [])
+        self.supported = (
+            self.lm is not None
+            and bool(self.delays)
+            and hasattr(self.lm, "_sample_next_token")
+            and hasattr(getattr(model, "compression_model", None), "decode")
+        )
+        self.steps = []
+        self._windows = 0
+        self._thread_id = None
+
+    @property
+    def frame_rate(self):
+        return getattr(self.model, "frame_rate", 50)
+
+    def expected_steps(self, duration):
+        return int(duration * self.frame_rate) + max(self.delays or [0])
+
+    @contextmanager
+    def recording(self):
+        """Оборачивает генерацию: вызывать в том же потоке, где идёт model.generate"""
+        if not self.supported or not _tap_lock.acquire(blocking=False):
+            self.supported = False
+            yield self
+            return
+        self._thread_id = threading.get_ident()
+        original_sample = self.lm._sample_next_token
+        original_generate = self.lm.generate
+
+        def generate(*args, **kwargs):
+            # Длинные треки (> max_duration) генерируются окнами с промптом из прошлого окна —
+            # линейная раскладка токенов верна только для первого окна
+            if threading.get_ident() == self._thread_id:
+                self._windows += 1
+            return original_generate(*args, **kwargs)
+
+        def sample_next_token(*args, **kwargs):
+            token = original_sample(*args, **kwargs)
+            if self._windows == 1 and threading.get_ident() == self._thread_id:
+                self.steps.append(token[..., 0].detach().clone())
+            return token
+
+        self.lm._sample_next_token = sample_next_token
+        self.lm.generate = generate
+        try:
+            yield self
+        finally:
+            # Убираем атрибуты экземпляра — снова работают методы класса
+            del self.lm._sample_next_token
+            del self.lm.generate
+            _tap_lock.release()
+
+    def decode(self):
+        """Декодирует готовый префикс в float32 numpy [samples] или None, если пока нечего"""
+        if not self.supported:
+            return None
+        import torch
+
+        steps = self.steps[:]
+        ready = len(steps) - max(self.delays)
+        if ready <= 0:
+            return None
+        try:
+            seq = torch.stack(steps, dim=-1)  # [B, K, steps]
+            codes = torch.stack(
+                [seq[:, k, d:d + ready] for k, d in enumerate(self.delays)], dim=1
+            )  # [B, K, T]
+            with torch.no_grad():
+                audio = self.model.compression_model.decode(codes, None)
+            return audio[0, 0].float().cpu().numpy()
+        except Exception as e:
+            # Превью — не критично: выключаем его и даём генерации закончиться
+            log(f"[MusicGen] Preview decode disabled: {e}")
+            self.supported = False
+            return None
@@ -1,236 +1,637 @@
 import os
 import time
 import threading
+from contextlib import contextmanager
 from pathlib import Path
-from audiocraft.models import MusicGen
-from TTS.api import TTS
-from pydub import AudioSegment
-import numpy as np
-from audio_utils import audio_write
-from helpers import log, create_safe_filename, OUTPUT_DIR
-
-# Загружаем модели сразу при импорте
-log("🔄 Loading MusicGen model...")
-musicgen = MusicGen.get_pretrained("facebook/musicgen-small")
-log("✅ MusicGen loaded!")
+from audio_utils import audio_read
+from helpers import log, create_safe_filename, track_output_path, unique_output_path, OUTPUT_DIR
+from admission import controller as admission, release_memory
+from music_preview import TokenTap
+import projects
+from profiling import profiled, current_capture
+from writebehind import writer
+from vocal_cache import cache as vocal_cache, assemble, GAP_MS, CROSSFADE_MS
+from multivoice import BatchedXTTS, arrange_duet
+from cost_model import model as cost_model
+from scheduler import scheduler
+from cancellation import Cancelled, check
+
+# LEON_STUB_MODELS=1 подменяет модели заглушками (API и нагрузочные тесты без GPU)
+if os.environ.get("LEON_STUB_MODELS") == "1":
+    from stub_models import StubMusicGen as MusicGen, StubTTS as TTS
+else:
+    from audiocraft.models import MusicGen
+    from TTS.api import TTS
+
+# Уровни моделей MusicGen: быстрый черновик и финальный рендер
+MUSICGEN_TIERS = {
+    "draft": os.environ.get("LEON_MUSICGEN_DRAFT", "facebook/musicgen-small"),
+    "final": os.environ.get("LEON_MUSICGEN_FINAL", "facebook/musicgen-medium"),
+}
+DRAFT_DURATION = int(os.environ.get("LEON_DRAFT_DURATION", "8"))
+# Черновик сэмплируется из более узкого top_k — меньше разброс, быстрее оценить промпт
+DRAFT_TOP_K = int(os.environ.get("LEON_DRAFT_TOP_K", "150"))
+
+# Не чаще чем раз в столько секунд декодируем превью — ограничивает накладные расходы EnCodec
+PREVIEW_INTERVAL = float(os.environ.get("LEON_PREVIEW_INTERVAL", "4"))
+
+_musicgen_models = {}
+_musicgen_lock = threading.Lock()
+# Параметры генерации и колбэк прогресса хранятся в самом экземпляре MusicGen,
+# поэтому на одном экземпляре одновременно генерирует только одно задание
+_model_locks = {}
+_model_locks_lock = threading.Lock()
+
+def get_musicgen(tier="draft"):
+    """Возвращает модель MusicGen уровня tier, загружая её при первом обращении"""
+    name = MUSICGEN_TIERS[tier]
+    with _musicgen_lock:
+        if name not in _musicgen_models:
+            log(f"🔄 Loading MusicGen model {name}...")
+            _musicgen_models[name] = MusicGen.get_pretrained(name)
+            log(f"✅ MusicGen {name} loaded!")
+            # Веса новой модели — часть простоя, а не расход задания
+            admission.mark_idle()
+        return _musicgen_models[name]
+
+def admission_kind(tier):
+    return "music" if MUSICGEN_TIERS[tier] == MUSICGEN_TIERS["draft"] else "music_final"
+
+# Загружаем модели сразу при импорте (финальный уровень — лениво, при первом рендере)
+musicgen = get_musicgen("draft")
 
 log("🔄 Loading XTTS model...")
 tts = TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", progress_bar=False)
 log("✅ XTTS loaded!")
+admission.mark_idle()
+
+def tts_sample_rate():
+    """Частота, на которой XTTS возвращает аудио из tts.tts()"""
+    synthesizer = getattr(tts, "synthesizer", None)
+    return getattr(synthesizer, "output_sample_rate", None) or getattr(tts, "sample_rate", 24000)
+
+def watch_cancel(model, cancel_token):
+    """Колбэк прогресса MusicGen вызывается на каждом шаге токенов — там и проверяем отмену"""
+    def callback(generated_tokens, tokens_to_generate):
+        check(cancel_token)
+    model.set_custom_progress_callback(callback)
+
+@contextmanager
+def exclusive(model, cancel_token=None):
+    """Монопольный доступ к модели от set_generation_params до конца generate; ожидание можно отменить"""
+    with _model_locks_lock:
+        lock = _model_locks.setdefault(id(model), threading.Lock())
+    while not lock.acquire(timeout=1.0):
+        check(cancel_token)
+    try:
+        check(cancel_token)
+        yield model
+    finally:
+        lock.release()
+
+class Worker(threading.Thread):
+    """Поток с моделью: запоминает результат или исключение target, их забирает result()"""
 
-def generate_music_workflow(prompt, duration, track_name, progress_fn=None):
+    def __init__(self, target):
+        super().__init__()
+        self._fn = target
+        # Поток попадает в профиль запроса, если он снимается
+        self._capture = current_capture()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            if self._capture is None:
+                self._result = self._fn()
+            else:
+                with self._capture.resumed():
+                    self._result = self._fn()
+        except Exception as e:
+            self._error = e
+
+    def result(self, cancel_token=None):
+        """Дожидается потока и возвращает результат; отмена важнее ошибки, ошибка потока пробрасывается"""
+        self.join()
+        check(cancel_token)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+def spawn(target):
+    """Запускает target в новом потоке Worker"""
+    worker = Worker(target)
+    worker.start()
+    return worker
+
+def run_in_thread(fn, progress_cb=None, cancel_token=None, interval=0.5):
+    """
+    Выполняет fn в отдельном потоке, пока тот работает — раз в interval вызывает
+    progress_cb(прошло секунд). Возвращает результат fn, его исключение пробрасывает.
+    """
+    start = time.time()
+    worker = spawn(fn)
+    while worker.is_alive():
+        if progress_cb:
+            progress_cb(time.time() - start)
+        worker.join(interval)
+    return worker.result(cancel_token)
+
+def cancelled_result(progress_fn, tag):
+    """Общая обработка отмены в except-блоках workflow"""
+    log(f"[{tag}] Cancelled")
+    if progress_fn:
+        progress_fn(0, "⏹ Генерация отменена")
+
+@profiled("music")
+def generate_music_workflow(prompt, duration, track_name, progress_fn=None, tier="draft", top_k=None, user=None,
+                            cancel_token=None, slot_held=False):
+    """slot_held — вызывающий уже занял слот планировщика"""
     start = time.time()
+    stage = f"music_{tier}"
     try:
-        # Этап 1: Настройка параметров
-        if progress_fn:
-            progress_fn(0.1, "⚙️ Настройка параметров генерации...")
-        
-        musicgen.set_generation_params(duration=int(duration))
-        time.sleep(0.3)
+        with scheduler.slot("music", cost_model.estimate(stage, duration), user, progress_fn, cancel_token,
+                            held=slot_held), \
+                admission.admit({admission_kind(tier): duration}, progress_fn, cancel_token):
+            model = get_musicgen(tier)
+            # Этап 1: Настройка параметров
+            if progress_fn:
+                progress_fn(0.1, "⚙️ Настройка параметров генерации...")
         
-        # Этап 2: Генерация музыки
-        if progress_fn:
-            progress_fn(0.15, f"🎵 Генерация музыки ({duration}с)... Это займет ~{duration*1.5:.0f} секунд")
+            params = {"duration": int(duration), "top_k": top_k} if top_k else {"duration": int(duration)}
+            time.sleep(0.3)
         
-        # Симуляция прогресса
-        estimated_time = max(duration * 1.5, 15)
-        start_gen = time.time()
+            # Этап 2: Генерация музыки
+            estimated_time = cost_model.estimate(stage, duration)
+            if progress_fn:
+                progress_fn(0.15, f"🎵 Генерация музыки ({duration}с)... Это займет ~{estimated_time:.0f} секунд")
         
-        # Запускаем генерацию в отдельном потоке
-        result_container = [None]
-        def generate():
-            result_container[0] = musicgen.generate([prompt])
+            start_gen = time.time()
         
-        gen_thread = threading.Thread(target=generate)
-        gen_thread.start()
+            def generate():
+                with exclusive(model, cancel_token):
+                    model.set_generation_params(**params)
+                    watch_cancel(model, cancel_token)
+                    return model.generate([prompt], progress=True)
         
-        # Симулируем прогресс
-        while gen_thread.is_alive():
-            elapsed = time.time() - start_gen
-            progress = min(0.15 + (elapsed / estimated_time) * 0.75, 0.9)
-            remaining = max(0, estimated_time - elapsed)
-            if progress_fn:
-                progress_fn(progress, f"🎵 Генерация музыки... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
-            time.sleep(0.5)
+            # Прогресс по оценке модели времени
+            def report(elapsed):
+                progress = min(0.15 + (elapsed / estimated_time) * 0.75, 0.9)
+                remaining = max(0, estimated_time - elapsed)
+                if progress_fn:
+                    progress_fn(progress, f"🎵 Генерация музыки... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
         
-        gen_thread.join()
-        wavs = result_container[0]
+            wavs = run_in_thread(generate, report, cancel_token)
+            cost_model.observe(stage, duration, time.time() - start_gen)
         
-        # Этап 3: Сохранение
-        if progress_fn:
-            progress_fn(0.95, "💾 Сохранение аудио файла...")
+            # Этап 3: Сохранение
+            if progress_fn:
+                progress_fn(0.95, "💾 Передача аудио на запись...")
         
-        safe_name = create_safe_filename(track_name)
-        wav_path = OUTPUT_DIR / f"{safe_name}.wav"
-        audio_write(str(wav_path), wavs[0].cpu(), musicgen.sample_rate)
+            wav_path = track_output_path(track_name)
+            # Запись идёт в фоне: интерфейс сразу получает аудио из памяти
+            writer.submit(wav_path, wavs[0].cpu(), model.sample_rate)
+            del wavs
         
-        if progress_fn:
-            progress_fn(1.0, f"✅ Готово! Трек создан за {time.time()-start:.1f}с")
+            if progress_fn:
+                progress_fn(1.0, f"✅ Готово! Трек создан за {time.time()-start:.1f}с")
         
-        elapsed = time.time() - start
-        log(f"[MusicGen] Track '{track_name}' created in {elapsed:.1f} sec.")
-        return str(wav_path)
+            elapsed = time.time() - start
+            log(f"[MusicGen] Track '{track_name}' created in {elapsed:.1f} sec.")
+            return str(wav_path)
         
+    except Cancelled:
+        cancelled_result(progress_fn, "MusicGen")
+        raise
     except Exception as e:
         log(f"[MusicGen] Error: {e}")
         if progress_fn:
             progress_fn(0, f"❌ Ошибка: {str(e)}")
         raise Exception(f"Critical error: {e}")
 
-def generate_song_with_voice(lyrics, genre, duration, voice_sample_path, progress_fn=None):
-    if not voice_sample_path or not os.path.isfile(voice_sample_path):
-        raise Exception("Please select a voice file for generation (record or upload)!")
-    
-    t0 = time.time()
+@profiled("music_stream")
+def stream_music_workflow(prompt, duration, track_name, progress_fn=None, preview_interval=PREVIEW_INTERVAL,
+                          user=None, cancel_token=None):
+    """
+    Как generate_music_workflow, но генератор: пока MusicGen работает, периодически
+    отдаёт ("preview", (sample_rate, новые сэмплы)), в конце — ("done", путь к файлу).
+    """
+    start = time.time()
     try:
-        # Этап 1: Генерация вокала
-        if progress_fn: 
-            progress_fn(0.1, f"🎤 Синтез голоса (~{len(lyrics)*0.3:.0f}с)...")
-        
-        vocal_path = OUTPUT_DIR / "vocal.wav"
-        
-        # TTS в отдельном потоке
-        tts_start = time.time()
-        estimated_tts_time = len(lyrics) * 0.3
-        
-        result_container = [None]
-        def generate_tts():
-            tts.tts_to_file(
-                text=lyrics,
-                speaker_wav=voice_sample_path,
-                language="en",
-                file_path=str(vocal_path),
-            )
-            result_container[0] = True
+        with scheduler.slot("music", cost_model.estimate("music_draft", duration), user, progress_fn, cancel_token), \
+                admission.admit({"music": duration}, progress_fn, cancel_token):
+            model = get_musicgen("draft")
+            tap = TokenTap(model)
         
-        tts_thread = threading.Thread(target=generate_tts)
-        tts_thread.start()
-        
-        while tts_thread.is_alive():
-            elapsed = time.time() - tts_start
-            progress = min(0.1 + (elapsed / estimated_tts_time) * 0.3, 0.4)
-            remaining = max(0, estimated_tts_time - elapsed)
             if progress_fn:
-                progress_fn(progress, f"🎤 Синтез голоса... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
-            time.sleep(0.3)
-        
-        tts_thread.join()
-        
-        # Этап 2: Генерация музыки
-        if progress_fn: 
-            progress_fn(0.45, f"🎵 Генерация {genre} инструментала ({duration}с)...")
-        
-        musicgen.set_generation_params(duration=int(duration))
-        prompt = f"{genre} instrumental"
+                progress_fn(0.1, f"🎵 Генерация музыки с превью ({duration}с)...")
+        
+            def generate():
+                with exclusive(model, cancel_token):
+                    model.set_generation_params(duration=int(duration))
+                    watch_cancel(model, cancel_token)
+                    with tap.recording():
+                        return model.generate([prompt], progress=True)
+        
+            # Между опросами отдаём превью — run_in_thread тут не подходит, поток опрашиваем сами
+            gen_start = time.time()
+            gen_thread = spawn(generate)
+        
+            estimated_time = cost_model.estimate("music_draft", duration)
+            total_steps = tap.expected_steps(duration)
+            sent = 0
+            last_decode = time.time()
+            while gen_thread.is_alive():
+                time.sleep(0.25)
+                elapsed = time.time() - gen_start
+                if tap.supported:
+                    # Реальный прогресс по числу сгенерированных шагов
+                    progress = min(0.1 + len(tap.steps) / total_steps * 0.8, 0.9)
+                else:
+                    progress = min(0.1 + (elapsed / estimated_time) * 0.8, 0.9)
+                if progress_fn:
+                    progress_fn(progress, f"🎵 Генерация музыки... {progress*100:.0f}%")
+        
+                if time.time() - last_decode < preview_interval:
+                    continue
+                last_decode = time.time()
+                audio = tap.decode()
+                if audio is not None and audio.shape[-1] > sent:
+                    yield "preview", (model.sample_rate, audio[sent:])
+                    sent = audio.shape[-1]
+        
+            wavs = gen_thread.result(cancel_token)
+            cost_model.observe("music_draft", duration, time.time() - gen_start)
+        
+            # Хвост, который не успели показать в превью
+            final_audio = wavs[0].cpu().numpy()
+            if final_audio.ndim > 1:
+                final_audio = final_audio[0]
+            if final_audio.shape[-1] > sent:
+                yield "preview", (model.sample_rate, final_audio[sent:])
         
-        music_start = time.time()
-        estimated_music_time = duration * 1.2
-        
-        music_container = [None]
-        def generate_music():
-            music_container[0] = musicgen.generate([prompt])
-        
-        music_thread = threading.Thread(target=generate_music)
-        music_thread.start()
-        
-        while music_thread.is_alive():
-            elapsed = time.time() - music_start
-            progress = min(0.45 + (elapsed / estimated_music_time) * 0.35, 0.8)
-            remaining = max(0, estimated_music_time - elapsed)
             if progress_fn:
-                progress_fn(progress, f"🎵 Создание инструментала... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
-            time.sleep(0.5)
-        
-        music_thread.join()
-        music = music_container[0]
-        
-        # Этап 3: Сохранение музыки
-        if progress_fn: 
-            progress_fn(0.85, "💾 Сохранение инструментала...")
+                progress_fn(0.95, "💾 Передача аудио на запись...")
         
-        music_path = OUTPUT_DIR / "music.wav"
-        audio_np = music[0].cpu().numpy()
-        if audio_np.ndim > 1: 
-            audio_np = audio_np[0]
-        audio_int16 = (audio_np * 32767).astype(np.int16)
-        AudioSegment(
-            audio_int16.tobytes(),
-            frame_rate=musicgen.sample_rate,
-            sample_width=2,
-            channels=1
-        ).export(music_path, format="wav")
+            wav_path = track_output_path(track_name)
+            # Запись идёт в фоне: интерфейс сразу получает аудио из памяти
+            writer.submit(wav_path, wavs[0].cpu(), model.sample_rate)
+            del wavs, final_audio
         
-        # Этап 4: Сведение треков
-        if progress_fn: 
-            progress_fn(0.9, "🎚️ Сведение вокала и инструментала...")
+            if progress_fn:
+                progress_fn(1.0, f"✅ Готово! Трек создан за {time.time()-start:.1f}с")
         
-        vocal = AudioSegment.from_wav(vocal_path)
-        instrumental = AudioSegment.from_wav(music_path)
-        min_len = min(len(vocal), len(instrumental))
-        out = instrumental[:min_len].overlay(vocal[:min_len])
+            log(f"[MusicGen] Track '{track_name}' streamed in {time.time()-start:.1f} sec.")
+            yield "done", str(wav_path)
         
-        out_path = OUTPUT_DIR / "final_song.wav"
-        out.export(out_path, format="wav")
+    except Cancelled:
+        cancelled_result(progress_fn, "MusicGen")
+        raise
+    except Exception as e:
+        log(f"[MusicGen] Error: {e}")
+        if progress_fn:
+            progress_fn(0, f"❌ Ошибка: {str(e)}")
+        raise Exception(f"Critical error: {e}")
+
+@profiled("song")
+def generate_song_with_voice(lyrics, genre, duration, voice_sample_path, progress_fn=None, song_name=None,
+                             gap_ms=GAP_MS, crossfade_ms=CROSSFADE_MS, user=None, cancel_token=None):
+    if not voice_sample_path or not os.path.isfile(voice_sample_path):
+        raise Exception("Please select a voice file for generation (record or upload)!")
+    
+    t0 = time.time()
+    try:
+        # Повторы строк берутся из кэша, поэтому время считаем только по новым
+        _, _, new_chars = vocal_cache.plan(lyrics, voice_sample_path)
+        cost = cost_model.estimate_job({"tts": new_chars, "music_draft": duration})
+        with scheduler.slot("song", cost, user, progress_fn, cancel_token), \
+                admission.admit({"tts": len(lyrics), "music": duration}, progress_fn, cancel_token):
+            estimated_tts_time = cost_model.estimate("tts", new_chars) if new_chars else 1.0
+            if progress_fn: 
+                progress_fn(0.1, f"🎤 Синтез голоса (~{estimated_tts_time:.0f}с)...")
+        
+            # Стемы сохраняются в проект, чтобы потом переделывать сведение без генерации
+            project = projects.new_project(song_name or f"{genre}_song")
+            vocal_path = project / "vocal.wav"
+        
+            # TTS в отдельном потоке, по строкам
+            tts_start = time.time()
+        
+            lines_done = [0, 0]
+            def on_line(done, total):
+                lines_done[:] = [done, total]
+            def generate_tts():
+                return vocal_cache.synthesize(
+                    batched_tts().synthesize, lyrics, voice_sample_path, tts_sample_rate(),
+                    gap_ms=gap_ms, crossfade_ms=crossfade_ms, on_line=on_line, cancel_token=cancel_token,
+                )
+            def report_tts(elapsed):
+                progress = min(0.1 + (elapsed / estimated_tts_time) * 0.3, 0.4)
+                remaining = max(0, estimated_tts_time - elapsed)
+                if progress_fn:
+                    progress_fn(progress, f"🎤 Синтез голоса... строка {lines_done[0]}/{lines_done[1]} (осталось ~{remaining:.0f}с)")
+        
+            vocal, vocal_stats = run_in_thread(generate_tts, report_tts, cancel_token, interval=0.3)
+            cost_model.observe("tts", vocal_stats["chars"], time.time() - tts_start)
+            projects.put_stem(vocal_path, vocal, tts_sample_rate())
+            writer.submit(vocal_path, vocal, tts_sample_rate(), apply_export_rate=False)
+            del vocal
+        
+            # Этап 2: Генерация музыки
+            if progress_fn: 
+                progress_fn(0.45, f"🎵 Генерация {genre} инструментала ({duration}с)...")
+        
+            prompt = f"{genre} instrumental"
+        
+            music_start = time.time()
+            estimated_music_time = cost_model.estimate("music_draft", duration)
+        
+            def generate_music():
+                with exclusive(musicgen, cancel_token):
+                    musicgen.set_generation_params(duration=int(duration))
+                    watch_cancel(musicgen, cancel_token)
+                    return musicgen.generate([prompt], progress=True)
+            def report_music(elapsed):
+                progress = min(0.45 + (elapsed / estimated_music_time) * 0.35, 0.8)
+                remaining = max(0, estimated_music_time - elapsed)
+                if progress_fn:
+                    progress_fn(progress, f"🎵 Создание инструментала... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
+        
+            music = run_in_thread(generate_music, report_music, cancel_token)
+            cost_model.observe("music_draft", duration, time.time() - music_start)
+        
+            # Этап 3: Сохранение музыки
+            if progress_fn: 
+                progress_fn(0.85, "💾 Передача инструментала на запись...")
+        
+            music_path = project / "music.wav"
+            audio_np = music[0].cpu().numpy()
+            if audio_np.ndim > 1: 
+                audio_np = audio_np[0]
+            # Стемы пишутся в фоне, сведение берёт их из памяти
+            projects.put_stem(music_path, audio_np, musicgen.sample_rate)
+            writer.submit(music_path, audio_np, musicgen.sample_rate, apply_export_rate=False)
+            del music, audio_np
+            release_memory()
+        
+            # Этап 4: Сведение треков
+            if progress_fn: 
+                progress_fn(0.9, "🎚️ Сведение вокала и инструментала...")
+        
+            projects.create_project_mix(
+                project, lyrics=lyrics, genre=genre, duration=duration,
+                voice=Path(voice_sample_path).name, gap_ms=gap_ms, crossfade_ms=crossfade_ms,
+            )
+            out_path = projects.render_project(project)
         
-        if progress_fn: 
-            progress_fn(1.0, f"✅ Песня готова за {time.time()-t0:.1f}с!")
+            if progress_fn: 
+                progress_fn(1.0, f"✅ Песня готова за {time.time()-t0:.1f}с! "
+                                 f"(повторов из кэша: {vocal_stats['saved']})")
         
-        elapsed = time.time() - t0
-        log(f"[TTS+MusicGen] Song ready in {elapsed:.1f} sec.")
-        return str(out_path)
+            elapsed = time.time() - t0
+            log(f"[TTS+MusicGen] Song '{project.name}' ready in {elapsed:.1f} sec.")
+            return str(out_path)
         
+    except Cancelled:
+        cancelled_result(progress_fn, "TTS+MusicGen")
+        raise
     except Exception as e:
         log(f"[TTS+MusicGen] Error: {e}")
         if progress_fn:
             progress_fn(0, f"❌ Ошибка: {str(e)}")
         raise Exception(f"Song generation error: {e}")
 
-def generate_tts_voice(lyrics, voice_path, progress_fn=None):
+@profiled("tts")
+def generate_tts_voice(lyrics, voice_path, progress_fn=None, gap_ms=GAP_MS, crossfade_ms=CROSSFADE_MS, user=None,
+                       cancel_token=None):
     if not voice_path or not os.path.isfile(voice_path):
         raise Exception("Please record or upload a voice file first!")
     
     t0 = time.time()
     try:
+        _, _, new_chars = vocal_cache.plan(lyrics, voice_path)
+        estimated_time = cost_model.estimate("tts", new_chars) if new_chars else 1.0
+        with scheduler.slot("tts", estimated_time, user, progress_fn, cancel_token), \
+                admission.admit({"tts": len(lyrics)}, progress_fn, cancel_token):
+            if progress_fn:
+                progress_fn(0.1, f"🎤 Подготовка синтеза голоса (~{estimated_time:.0f}с)...")
+        
+            # У каждого синтеза свой файл: результат задания API не перезапишет следующий запрос
+            out_path = unique_output_path("tts_voice")
+        
+            # TTS с прогрессом, по строкам
+            tts_start = time.time()
+        
+            lines_done = [0, 0]
+            def on_line(done, total):
+                lines_done[:] = [done, total]
+            def generate_tts():
+                return vocal_cache.synthesize(
+                    batched_tts().synthesize, lyrics, voice_path, tts_sample_rate(),
+                    gap_ms=gap_ms, crossfade_ms=crossfade_ms, on_line=on_line, cancel_token=cancel_token,
+                )
+            def report(elapsed):
+                progress = min(0.1 + (elapsed / estimated_time) * 0.8, 0.9)
+                remaining = max(0, estimated_time - elapsed)
+                if progress_fn:
+                    progress_fn(progress, f"🎤 Синтез голоса... строка {lines_done[0]}/{lines_done[1]} (осталось ~{remaining:.0f}с)")
+        
+            vocal, vocal_stats = run_in_thread(generate_tts, report, cancel_token, interval=0.3)
+            cost_model.observe("tts", vocal_stats["chars"], time.time() - tts_start)
+            writer.submit(out_path, vocal, tts_sample_rate())
+            del vocal
+        
+            if progress_fn:
+                progress_fn(1.0, f"✅ Голос синтезирован за {time.time()-t0:.1f}с! "
+                                 f"(повторов из кэша: {vocal_stats['saved']})")
+        
+            log(f"[TTS] Voice generated in {time.time()-t0:.1f} sec.")
+            return str(out_path)
+        
+    except Cancelled:
+        cancelled_result(progress_fn, "TTS")
+        raise
+    except Exception as e:
+        log(f"[TTS] Error: {e}")
         if progress_fn:
-            progress_fn(0.1, f"🎤 Подготовка синтеза голоса (~{len(lyrics)*0.2:.0f}с)...")
+            progress_fn(0, f"❌ Ошибка: {str(e)}")
+        raise Exception(f"TTS error: {e}")
+
+MULTI_VOICE_MODES = ("stems", "duet")
+# Обёртку XTTS создаём лениво: латенты голосов кэшируются внутри неё и общие
+# для одиночного (по строкам) и многоголосого синтеза
+_batched_tts = None
+_batched_tts_lock = threading.Lock()
+
+def batched_tts():
+    global _batched_tts
+    with _batched_tts_lock:
+        if _batched_tts is None:
+            _batched_tts = BatchedXTTS(tts)
+        return _batched_tts
+
+@profiled("tts_multi")
+def generate_multi_voice(lyrics, voice_paths, mode="stems", progress_fn=None, gap_ms=GAP_MS,
+                         crossfade_ms=CROSSFADE_MS, user=None, cancel_token=None):
+    """
+    Один текст несколькими голосами: stems — отдельный файл на голос, duet — строки по очереди,
+    припев вместе (плюс те же стемы). Возвращает список путей, основной результат — первый.
+    """
+    voice_paths = list(dict.fromkeys(voice_paths or []))
+    if len(voice_paths) < 2:
+        raise Exception("Select at least two voices!")
+    missing = [v for v in voice_paths if not os.path.isfile(v)]
+    if missing:
+        raise Exception(f"Voice not found: {Path(missing[0]).name}")
+    if mode not in MULTI_VOICE_MODES:
+        raise Exception(f"Unknown mode: {mode}")
+    
+    try:
+        # Оценка последовательного синтеза по одному голосу (модель времени учится на одиночных TTS)
+        new_chars = [vocal_cache.plan(lyrics, v)[2] for v in voice_paths]
+        sequential_time = sum(cost_model.estimate("tts", c) for c in new_chars if c) or 1.0
+        with scheduler.slot("tts", sequential_time, user, progress_fn, cancel_token), \
+                admission.admit({"tts": len(lyrics) * len(voice_paths)}, progress_fn, cancel_token):
+            if progress_fn:
+                progress_fn(0.1, f"👥 Синтез {len(voice_paths)} голосами...")
+        
+            tts_start = time.time()
+            lines_done = [0, 0]
+            def on_line(done, total):
+                lines_done[:] = [done, total]
+            def generate_tts():
+                return vocal_cache.synthesize_many(
+                    batched_tts(), lyrics, voice_paths, tts_sample_rate(),
+                    on_line=on_line, cancel_token=cancel_token,
+                )
+            def report(elapsed):
+                done, total = lines_done
+                progress = 0.1 + (done / total) * 0.8 if total else 0.1
+                if progress_fn:
+                    progress_fn(progress, f"👥 Синтез голосов... строка {done}/{total}")
+        
+            keys, segments, stats = run_in_thread(generate_tts, report, cancel_token, interval=0.3)
+            elapsed = time.time() - tts_start
         
-        out_path = OUTPUT_DIR / "tts_voice.wav"
+            if progress_fn:
+                progress_fn(0.92, "💾 Сборка и передача на запись...")
+        
+            sample_rate = tts_sample_rate()
+            paths = []
+            # Общий уникальный префикс запуска: файлы прошлых заданий не перезаписываются
+            run = unique_output_path("tts_multi").stem
+            if mode == "duet":
+                duet_path = OUTPUT_DIR / f"{run}_duet.wav"
+                writer.submit(duet_path, arrange_duet(keys, segments, sample_rate, gap_ms, crossfade_ms), sample_rate)
+                paths.append(str(duet_path))
+            for voice in voice_paths:
+                stem_path = OUTPUT_DIR / f"{run}_{create_safe_filename(Path(voice).stem).replace(' ', '_')}.wav"
+                writer.submit(stem_path, assemble(segments[voice], sample_rate, gap_ms, crossfade_ms), sample_rate)
+                paths.append(str(stem_path))
+            del segments
+        
+            batched = batched_tts().batched
+            speedup = ""
+            if stats["synthesized"] and batched:
+                # Последовательный вариант не запускали — сравниваем с оценкой, а не с замером
+                speedup = f", x{sequential_time / elapsed:.1f} vs ~{sequential_time:.0f}s estimated sequential"
+            elif stats["synthesized"]:
+                # Без батча это и есть последовательный синтез — обычный замер для модели времени
+                cost_model.observe("tts", stats["chars"], elapsed)
+            summary = (f"{len(voice_paths)} voices, {stats['synthesized']} lines synthesized in "
+                       f"{stats['batches']} batches in {elapsed:.1f}s{speedup}")
+            log(f"[TTS] Multi-voice ({'batched' if batched else 'sequential'}): {summary}")
+            if progress_fn:
+                progress_fn(1.0, f"✅ {summary}")
+            return paths
         
-        # TTS с прогрессом
-        tts_start = time.time()
-        estimated_time = len(lyrics) * 0.2
+    except Cancelled:
+        cancelled_result(progress_fn, "TTS")
+        raise
+    except Exception as e:
+        log(f"[TTS] Multi-voice error: {e}")
+        if progress_fn:
+            progress_fn(0, f"❌ Ошибка: {str(e)}")
+        raise Exception(f"Multi-voice TTS error: {e}")
+
+@profiled("draft")
+def generate_music_draft(prompt, track_name, progress_fn=None, duration=DRAFT_DURATION, user=None,
+                         cancel_token=None):
+    """Быстрый черновик: короткая длительность, модель уровня draft, узкий top_k"""
+    with scheduler.slot("draft", cost_model.estimate("music_draft", duration), user, progress_fn, cancel_token):
+        return generate_music_workflow(
+            prompt, duration, f"{track_name}_draft", progress_fn, tier="draft", top_k=DRAFT_TOP_K, user=user,
+            cancel_token=cancel_token, slot_held=True,
+        )
+
+@profiled("refine")
+def refine_music_workflow(draft_path, prompt, duration, track_name, progress_fn=None, tier="final", user=None,
+                          cancel_token=None):
+    """
+    Финальный рендер принятого черновика: модель уровня tier продолжает
+    черновик до полной длительности (черновик — контекст продолжения).
+    """
+    if not draft_path or not os.path.isfile(draft_path):
+        raise Exception("Draft not found, generate a draft first!")
+    
+    start = time.time()
+    stage = f"music_{tier}"
+    try:
+        # Продолжается примерно duration минус длина черновика
+        cost = cost_model.estimate(stage, max(duration - DRAFT_DURATION, 1))
+        with scheduler.slot("refine", cost, user, progress_fn, cancel_token), \
+                admission.admit({admission_kind(tier): duration}, progress_fn, cancel_token):
+            if progress_fn:
+                progress_fn(0.05, f"🔄 Загрузка модели {MUSICGEN_TIERS[tier]}...")
+            model = get_musicgen(tier)
         
-        result_container = [None]
-        def generate_tts():
-            tts.tts_to_file(
-                text=lyrics,
-                speaker_wav=voice_path,
-                language="en",
-                file_path=str(out_path),
-            )
-            result_container[0] = True
+            import torch
+            draft, draft_sr = audio_read(draft_path)
+            prompt_wav = torch.from_numpy(draft[:1]).unsqueeze(0)  # [1, 1, T]
+            draft_seconds = draft.shape[-1] / draft_sr
+            # Продолжение должно быть длиннее контекста
+            total = max(int(duration), int(draft_seconds) + 1)
         
-        tts_thread = threading.Thread(target=generate_tts)
-        tts_thread.start()
+            estimated_time = cost_model.estimate(stage, total - draft_seconds)
+            if progress_fn:
+                progress_fn(0.15, f"🎼 Финальный рендер ({total}с)... Это займет ~{estimated_time:.0f} секунд")
+        
+            def generate():
+                with exclusive(model, cancel_token):
+                    model.set_generation_params(duration=total)
+                    watch_cancel(model, cancel_token)
+                    return model.generate_continuation(
+                        prompt_wav, prompt_sample_rate=draft_sr, descriptions=[prompt], progress=True
+                    )
+            def report(elapsed):
+                progress = min(0.15 + (elapsed / estimated_time) * 0.75, 0.9)
+                remaining = max(0, estimated_time - elapsed)
+                if progress_fn:
+                    progress_fn(progress, f"🎼 Финальный рендер... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
+        
+            gen_start = time.time()
+            wavs = run_in_thread(generate, report, cancel_token)
+            cost_model.observe(stage, total - draft_seconds, time.time() - gen_start)
         
-        while tts_thread.is_alive():
-            elapsed = time.time() - tts_start
-            progress = min(0.1 + (elapsed / estimated_time) * 0.8, 0.9)
-            remaining = max(0, estimated_time - elapsed)
             if progress_fn:
-                progress_fn(progress, f"🎤 Синтез голоса... {progress*100:.0f}% (осталось ~{remaining:.0f}с)")
-            time.sleep(0.3)
+                progress_fn(0.95, "💾 Передача аудио на запись...")
         
-        tts_thread.join()
+            wav_path = track_output_path(track_name)
+            # Запись идёт в фоне: интерфейс сразу получает аудио из памяти
+            writer.submit(wav_path, wavs[0].cpu(), model.sample_rate)
+            del wavs, prompt_wav
         
-        if progress_fn:
-            progress_fn(1.0, f"✅ Голос синтезирован за {time.time()-t0:.1f}с!")
+            if progress_fn:
+                progress_fn(1.0, f"✅ Финальная версия готова за {time.time()-start:.1f}с")
         
-        log(f"[TTS] Voice generated in {time.time()-t0:.1f} sec.")
-        return str(out_path)
+            log(f"[MusicGen] Final '{track_name}' rendered with {MUSICGEN_TIERS[tier]} in {time.time()-start:.1f} sec.")
+            return str(wav_path)
         
+    except Cancelled:
+        cancelled_result(progress_fn, "MusicGen")
+        raise
     except Exception as e:
-        log(f"[TTS] Error: {e}")
+        log(f"[MusicGen] Refine error: {e}")
         if progress_fn:
             progress_fn(0, f"❌ Ошибка: {str(e)}")
-        raise Exception(f"TTS error: {e}")
\ No newline at end of file
+        raise Exception(f"Refine error: {e}")
\ No newline at end of file
@@ -0,0 +1,282 @@
+"""
+Профилирование отдельных запросов по запросу или выборочно.
+
+Декоратор @profiled("music") оборачивает функцию music_workflow. Профиль снимается,
+если вызов пришёл с profile=True или выпал по выборке LEON_PROFILE_SAMPLE (в процентах).
+В PROFILE_DIR пишутся:
+- <id>.trace.json     — Chrome trace (chrome://tracing, Perfetto) по сэмплам Python-стеков потоков запроса
+                        (поток вызова и потоки, запущенные через music_workflow.spawn, но не другие запросы);
+- <id>.collapsed.txt  — collapsed stacks для flamegraph.pl / speedscope;
+- <id>.torch.json     — Chrome trace torch.profiler (если есть torch и LEON_PROFILE_TORCH != 0);
+- index.json          — самые медленные из снятых запросов с их параметрами.
+Общий объём папки ограничен LEON_PROFILE_MAX_MB — старые профили удаляются.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from helpers import log
+
+PROFILE_DIR = Path("Leon_profiles")
+INDEX_FILE = PROFILE_DIR / "index.json"
+
+SAMPLE_PERCENT = float(os.environ.get("LEON_PROFILE_SAMPLE", "0"))
+SAMPLE_INTERVAL = float(os.environ.get("LEON_PROFILE_INTERVAL_MS", "10")) / 1000
+USE_TORCH = os.environ.get("LEON_PROFILE_TORCH", "1") != "0"
+MAX_DIR_MB = float(os.environ.get("LEON_PROFILE_MAX_MB", "200"))
+INDEX_SIZE = int(os.environ.get("LEON_PROFILE_INDEX_SIZE", "20"))
+
+# Профиль, который сейчас снимается в этом контексте. Вложенные вызовы (черновик ->
+# generate_music_workflow) профилируем один раз. Не thread-local: генератор стрима
+# Gradio продолжает на разных потоках пула
+_active = contextvars.ContextVar("leon_profile", default=None)
+_index_lock = threading.Lock()
+
+
+def current_capture():
+    """Профиль запроса, в котором выполняется текущий код (или None)"""
+    return _active.get()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+class StackSampler:
+    """
+    Сэмплирует стеки потоков через sys._current_frames(); owns(thread) решает,
+    какие потоки относятся к запросу (None — все потоки процесса).
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, owns=None):
+        self.interval = interval
+        self.owns = owns
+        self.collapsed = Counter()
+        self.events = []
+        self._open = {}  # thread id -> текущий стек (список имён кадров)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="leon-profiler", daemon=True)
+        self._t0 = time.perf_counter()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        now = self._ts()
+        for tid in list(self._open):
+            self._switch(tid, [], now)
+
+    def _ts(self):
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = self._ts()
+            threads = {t.ident: t for t in threading.enumerate()}
+            names = {tid: t.name for tid, t in threads.items()}
+            frames = sys._current_frames()
+            if self.owns is not None:
+                frames = {tid: f for tid, f in frames.items() if tid in threads and self.owns(threads[tid])}
+            for tid, frame in frames.items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.reverse()
+                thread_name = names.get(tid, str(tid))
+                self.collapsed[";".join([thread_name] + stack)] += 1
+                self._switch(tid, stack, now)
+            for tid in [t for t in self._open if t not in frames]:
+                self._switch(tid, [], now)
+
+    def _switch(self, tid, stack, ts):
+        """Превращает смену стека в пары B/E событий Chrome trace"""
+        previous = self._open.get(tid, [])
+        common = 0
+        while common < min(len(previous), len(stack)) and previous[common] == stack[common]:
+            common += 1
+        for name in reversed(previous[common:]):
+            self.events.append({"name": name, "ph": "E", "ts": ts, "pid": os.getpid(), "tid": tid})
+        for name in stack[common:]:
+            self.events.append({"name": name, "ph": "B", "ts": ts, "pid": os.getpid(), "tid": tid})
+        self._open[tid] = stack
+
+
+def _describe_params(fn, args, kwargs):
+    """Параметры запроса для тегов: длинный текст заменяем длиной"""
+    try:
+        bound = inspect.signature(fn).bind_partial(*args, **kwargs)
+    except TypeError:
+        return {}
+    params = {}
+    for name, value in bound.arguments.items():
+        if callable(value):
+            continue
+        if isinstance(value, str) and len(value) > 80:
+            params[f"{name}_len"] = len(value)
+        elif isinstance(value, (str, int, float, bool)) or value is None:
+            params[name] = value
+        else:
+            params[name] = repr(value)[:80]
+    return params
+
+
+def _should_profile(flag):
+    if flag is not None:
+        return bool(flag)
+    return SAMPLE_PERCENT > 0 and random.random() * 100 < SAMPLE_PERCENT
+
+
+class _Capture:
+    def __init__(self, kind, params):
+        self.kind = kind
+        self.params = params
+        self.id = f"{time.strftime('%Y%m%d_%H%M%S')}_{kind}_{uuid.uuid4().hex[:6]}"
+        # Потоки, которые сейчас выполняют сам запрос (у генератора меняются между yield)
+        self.running = set()
+        self.sampler = StackSampler(owns=self.owns)
+        self.torch_prof = None
+
+    def owns(self, thread):
+        return thread.ident in self.running
+
+    @contextmanager
+    def resumed(self):
+        """Код запроса выполняется в текущем потоке: поток в профиле, пока не выйдет из блока"""
+        token = _active.set(self)
+        self.running.add(threading.get_ident())
+        try:
+            yield
+        finally:
+            self.running.discard(threading.get_ident())
+            _active.reset(token)
+
+    def __enter__(self):
+        self.start = time.time()
+        if USE_TORCH:
+            try:
+                import torch
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.torch_prof = torch.profiler.profile(activities=activities)
+                self.torch_prof.__enter__()
+            except Exception as e:
+                log(f"[Profiler] torch profiler unavailable: {e}")
+                self.torch_prof = None
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.sampler.stop()
+        duration = time.time() - self.start
+        PROFILE_DIR.mkdir(exist_ok=True)
+        files = []
+        meta = {"kind": self.kind, "params": self.params, "duration": duration,
+                "failed": exc_type is not None}
+        if self.torch_prof is not None:
+            try:
+                self.torch_prof.__exit__(None, None, None)
+                path = PROFILE_DIR / f"{self.id}.torch.json"
+                self.torch_prof.export_chrome_trace(str(path))
+                files.append(path.name)
+            except Exception as e:
+                log(f"[Profiler] torch trace export failed: {e}")
+
+        trace_path = PROFILE_DIR / f"{self.id}.trace.json"
+        trace_path.write_text(json.dumps({"traceEvents": self.sampler.events, "otherData": meta}))
+        collapsed_path = PROFILE_DIR / f"{self.id}.collapsed.txt"
+        collapsed_path.write_text("".join(f"{stack} {n}\n" for stack, n in self.sampler.collapsed.most_common()))
+        files += [trace_path.name, collapsed_path.name]
+
+        _record(dict(meta, id=self.id, time=self.start, files=files))
+        log(f"[Profiler] {self.kind} request profiled in {duration:.1f} sec -> {PROFILE_DIR / self.id}.*")
+        return False
+
+
+def _record(entry):
+    """Добавляет профиль в индекс самых медленных и держит папку в пределах лимита"""
+    with _index_lock:
+        try:
+            index = json.loads(INDEX_FILE.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            index = []
+        index.append(entry)
+        index.sort(key=lambda e: e["duration"], reverse=True)
+
+        # Лимит объёма: удаляем самые старые профили
+        files = sorted((p for p in PROFILE_DIR.iterdir() if p.name != INDEX_FILE.name),
+                       key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        while files and total > MAX_DIR_MB * 1024 * 1024:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink()
+        existing = {p.name for p in files}
+        index = [e for e in index if all(f in existing for f in e["files"])][:INDEX_SIZE]
+
+        tmp = INDEX_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, INDEX_FILE)
+
+
+def slowest_profiles():
+    try:
+        return json.loads(INDEX_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return []
+
+
+def profiled(kind):
+    """
+    Декоратор функций music_workflow: добавляет необязательный аргумент profile
+    (True/False, None — по выборке LEON_PROFILE_SAMPLE).
+    """
+    def decorate(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen_wrapper(*args, profile=None, **kwargs):
+                if current_capture() is not None or not _should_profile(profile):
+                    yield from fn(*args, **kwargs)
+                    return
+                with _Capture(kind, _describe_params(fn, args, kwargs)) as capture:
+                    gen = fn(*args, **kwargs)
+                    try:
+                        while True:
+                            # Флаг ставится только на время шага: между yield поток пула
+                            # может выполнять чужие запросы
+                            with capture.resumed():
+                                try:
+                                    item = next(gen)
+                                except StopIteration:
+                                    return
+                            yield item
+                    finally:
+                        gen.close()
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, profile=None, **kwargs):
+            if current_capture() is not None or not _should_profile(profile):
+                return fn(*args, **kwargs)
+            with _Capture(kind, _describe_params(fn, args, kwargs)) as capture, capture.resumed():
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,255 @@
+"""
+Проекты песен: стемы + JSON-описание сведения.
+
+Каждая песня хранится как папка OUTPUT_DIR/projects/<slug>/ с файлами
+vocal.wav, music.wav и mix.json. Готовый трек — OUTPUT_DIR/<slug>.wav.
+Ремикс (громкости, сдвиг вокала, фейды, эффекты) пересобирает только сведение
+из закэшированных стемов — модели заново не запускаются.
+"""
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from audio_utils import audio_read
+from resample import resample
+from helpers import OUTPUT_DIR, create_safe_filename, log
+from writebehind import writer
+
+PROJECTS_DIR = OUTPUT_DIR / "projects"
+PROJECTS_DIR.mkdir(exist_ok=True)
+
+MIX_FILE = "mix.json"
+STEMS = ("vocal", "music")
+
+TRACK_DEFAULTS = {"gain_db": 0.0, "offset_ms": 0, "fade_in_ms": 0, "fade_out_ms": 0, "effects": []}
+
+# Без изменений сведение совпадает со старым: музыка + вокал, обрезка по короткому стему
+DEFAULT_MIX = {
+    "version": 1,
+    "length": "shortest",  # или "longest"
+    "tracks": {name: dict(TRACK_DEFAULTS) for name in STEMS},
+    "master": {"gain_db": 0.0, "fade_in_ms": 0, "fade_out_ms": 0, "effects": []},
+}
+
+# Стемы держим в памяти, чтобы ремикс не читал диск: ключ (путь, частота),
+# в значении — mtime файла на момент чтения (None — положили сами из памяти)
+_STEM_CACHE_SIZE = 16
+_stem_cache = {}
+_stem_lock = threading.Lock()
+
+
+# === Проекты ===
+
+def new_project(name="song"):
+    """Создаёт пустую папку проекта с уникальным именем"""
+    slug = f"{create_safe_filename(name).replace(' ', '_')}_{time.strftime('%Y%m%d_%H%M%S')}"
+    path = PROJECTS_DIR / slug
+    counter = 1
+    while path.exists():
+        path = PROJECTS_DIR / f"{slug}_{counter}"
+        counter += 1
+    path.mkdir(parents=True)
+    return path
+
+
+def project_dir(project):
+    """Принимает slug, папку проекта или путь к готовому треку"""
+    path = PROJECTS_DIR / Path(str(project)).stem
+    if not (path / MIX_FILE).is_file():
+        raise Exception(f"Project not found: {project}")
+    return path
+
+
+def output_path(project):
+    return OUTPUT_DIR / f"{Path(project).name}.wav"
+
+
+def list_projects():
+    """Проекты, новые первыми"""
+    projects = [p for p in PROJECTS_DIR.iterdir() if (p / MIX_FILE).is_file()]
+    projects.sort(key=lambda p: (p / MIX_FILE).stat().st_mtime, reverse=True)
+    return [p.name for p in projects]
+
+
+def load_mix(project):
+    data = json.loads((project_dir(project) / MIX_FILE).read_text(encoding="utf-8"))
+    mix = copy.deepcopy(DEFAULT_MIX)
+    mix.update({k: v for k, v in data.items() if k not in ("tracks", "master")})
+    for name in STEMS:
+        mix["tracks"][name].update(data.get("tracks", {}).get(name, {}))
+    mix["master"].update(data.get("master", {}))
+    return mix
+
+
+def save_mix(project, mix):
+    path = Path(project) / MIX_FILE
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(mix, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def create_project_mix(project, **meta):
+    """Сохраняет mix.json по умолчанию с метаданными генерации (текст, жанр, голос...)"""
+    mix = copy.deepcopy(DEFAULT_MIX)
+    mix["meta"] = meta
+    save_mix(project, mix)
+    return mix
+
+
+def delete_project(project):
+    shutil.rmtree(PROJECTS_DIR / Path(str(project)).name, ignore_errors=True)
+
+
+# === Сведение ===
+
+def _mtime(path):
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _cache_put(key, mtime, stem):
+    with _stem_lock:
+        _stem_cache.pop(key, None)
+        _stem_cache[key] = (mtime, stem)
+        while len(_stem_cache) > _STEM_CACHE_SIZE:
+            _stem_cache.pop(next(iter(_stem_cache)))
+
+
+def put_stem(path, samples, sample_rate):
+    """Кладёт только что сгенерированный стем в кэш — сведение не ждёт записи на диск"""
+    _cache_put((str(Path(path)), None), None, (np.asarray(samples, dtype=np.float32), sample_rate))
+
+
+def load_stem(path, sample_rate=None):
+    """Стем как float32 моно + частота (при sample_rate — уже передискретизированный), с кэшем в памяти"""
+    path = Path(path)
+    key = (str(path), sample_rate)
+    with _stem_lock:
+        entry = _stem_cache.get(key)
+    if entry is not None and (entry[0] is None or entry[0] == _mtime(path)):
+        return entry[1]
+    if sample_rate is None:
+        samples, native_rate = audio_read(str(path), mono=True)
+        stem = (samples[0], native_rate)
+    else:
+        samples, native_rate = load_stem(path)
+        stem = (resample(samples, native_rate, sample_rate), sample_rate)
+    _cache_put(key, _mtime(path), stem)
+    return stem
+
+
+def _db(gain_db):
+    return np.float32(10 ** (gain_db / 20.0))
+
+
+def _apply_fades(x, sample_rate, fade_in_ms, fade_out_ms):
+    n_in = min(int(sample_rate * fade_in_ms / 1000), len(x))
+    n_out = min(int(sample_rate * fade_out_ms / 1000), len(x))
+    if n_in > 0:
+        x[:n_in] *= np.linspace(0.0, 1.0, n_in, dtype=np.float32)
+    if n_out > 0:
+        x[len(x) - n_out:] *= np.linspace(1.0, 0.0, n_out, dtype=np.float32)
+    return x
+
+
+def _apply_effects(x, sample_rate, effects):
+    for effect in effects:
+        kind = effect.get("type")
+        if kind == "normalize":
+            peak = np.abs(x).max() if len(x) else 0.0
+            if peak > 0:
+                x *= _db(effect.get("peak_db", -1.0)) / peak
+        elif kind == "echo":
+            delay = int(sample_rate * effect.get("delay_ms", 250) / 1000)
+            if 0 < delay < len(x):
+                x[delay:] += x[:-delay] * np.float32(effect.get("decay", 0.3))
+        else:
+            log(f"[Projects] Unknown effect skipped: {kind}")
+    return x
+
+
+def render_mix(project, mix=None):
+    """Собирает трек из стемов по описанию сведения: (float32 моно, частота)"""
+    project = project_dir(project)
+    mix = mix or load_mix(project)
+    # Сводим на самой высокой частоте (как pydub при overlay), но через полифазный ресэмплер
+    sample_rate = max(load_stem(project / f"{name}.wav")[1] for name in STEMS)
+
+    tracks = []
+    for name in STEMS:
+        settings = mix["tracks"][name]
+        samples, _ = load_stem(project / f"{name}.wav", sample_rate)
+        x = samples.astype(np.float32, copy=True)
+        offset = int(sample_rate * settings["offset_ms"] / 1000)
+        if offset > 0:
+            x = np.concatenate([np.zeros(offset, dtype=np.float32), x])
+        elif offset < 0:
+            x = x[-offset:]
+        x *= _db(settings["gain_db"])
+        x = _apply_fades(x, sample_rate, settings["fade_in_ms"], settings["fade_out_ms"])
+        tracks.append(_apply_effects(x, sample_rate, settings["effects"]))
+
+    lengths = [len(t) for t in tracks]
+    length = min(lengths) if mix["length"] == "shortest" else max(lengths)
+    out = np.zeros(length, dtype=np.float32)
+    for t in tracks:
+        n = min(len(t), length)
+        out[:n] += t[:n]
+
+    master = mix["master"]
+    out *= _db(master["gain_db"])
+    out = _apply_fades(out, sample_rate, master["fade_in_ms"], master["fade_out_ms"])
+    out = _apply_effects(out, sample_rate, master["effects"])
+    return out, sample_rate
+
+
+def render_project(project):
+    """Пересобирает готовый трек проекта и возвращает путь к нему (запись идёт в фоне)"""
+    project = project_dir(project)
+    audio, sample_rate = render_mix(project)
+    out_path = output_path(project)
+    writer.submit(out_path, audio, sample_rate)
+    return str(out_path)
+
+
+def remix_project(project, vocal_gain_db=None, music_gain_db=None, vocal_offset_ms=None,
+                  fade_in_ms=None, fade_out_ms=None, normalize=None, mix=None):
+    """Меняет параметры сведения и пересобирает трек из закэшированных стемов"""
+    t0 = time.time()
+    project = project_dir(project)
+    current = load_mix(project)
+    if mix:
+        for name in STEMS:
+            current["tracks"][name].update(mix.get("tracks", {}).get(name, {}))
+        current["master"].update(mix.get("master", {}))
+        current["length"] = mix.get("length", current["length"])
+    updates = {
+        ("tracks", "vocal", "gain_db"): vocal_gain_db,
+        ("tracks", "music", "gain_db"): music_gain_db,
+        ("tracks", "vocal", "offset_ms"): vocal_offset_ms,
+        ("master", None, "fade_in_ms"): fade_in_ms,
+        ("master", None, "fade_out_ms"): fade_out_ms,
+    }
+    for (section, track, key), value in updates.items():
+        if value is None:
+            continue
+        target = current[section][track] if track else current[section]
+        target[key] = value
+    if normalize is not None:
+        effects = [e for e in current["master"]["effects"] if e.get("type") != "normalize"]
+        if normalize:
+            effects.append({"type": "normalize", "peak_db": -1.0})
+        current["master"]["effects"] = effects
+
+    save_mix(project, current)
+    out = render_project(project)
+    log(f"[Projects] Remixed '{project.name}' in {(time.time() - t0) * 1000:.0f} ms")
+    return out
@@ -0,0 +1,169 @@
+"""
+Передискретизация полифазным фильтром.
+
+В приложении встречаются три частоты: запись/загрузка голоса (обычно 44.1 или 48 кГц),
+XTTS (24 кГц) и MusicGen (32 кГц). Все переходы между ними идут через этот модуль:
+ФНЧ — windowed-sinc с окном Кайзера, разложенный на up фаз; ядро строится один раз
+на пару частот (lru_cache). Обработка блочная и векторизованная, StreamResampler
+хранит хвост входа между блоками, поэтому работает и на потоках.
+
+    python resample.py --bench   # сравнение с audioop.ratecv, который использует pydub
+"""
+import functools
+import math
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Длина фильтра в отсчётах на один «период» более низкой частоты
+TAPS = 32
+KAISER_BETA = 8.6
+# Полоса пропускания относительно новой частоты Найквиста
+ROLLOFF = 0.94
+BLOCK = 65536
+
+
+@functools.lru_cache(maxsize=32)
+def design_kernel(src_rate: int, dst_rate: int, taps: int = TAPS):
+    """
+    Возвращает (up, down, delay, phases[up, taps_per_phase]) для пары частот.
+    Фазы хранятся развёрнутыми: phases[p][j] = h[p + (taps_per_phase - 1 - j) * up],
+    чтобы выход считался как окно входа @ фаза.
+    """
+    g = math.gcd(src_rate, dst_rate)
+    up, down = dst_rate // g, src_rate // g
+    # Длина фильтра растёт с коэффициентом прореживания, иначе переходная полоса слишком широкая
+    taps_per_phase = -(-taps * max(up, down) // up)
+    # Нечётная длина — целая групповая задержка; добиваем нулём до taps_per_phase * up.
+    # Для этого произведение должно быть чётным (при нечётных up и taps_per_phase — +1 отвод)
+    if taps_per_phase * up % 2:
+        taps_per_phase += 1
+    n_taps = taps_per_phase * up - 1
+    cutoff = ROLLOFF / max(up, down)
+    t = np.arange(n_taps) - (n_taps - 1) / 2
+    h = cutoff * np.sinc(cutoff * t) * np.kaiser(n_taps, KAISER_BETA) * up
+    h = np.append(h, 0.0)
+    phases = h.reshape(taps_per_phase, up).T[:, ::-1].astype(np.float32)
+    phases.setflags(write=False)
+    return up, down, (n_taps - 1) // 2, phases
+
+
+class StreamResampler:
+    """Передискретизация потока блоками; форма входа [..., samples]"""
+
+    def __init__(self, src_rate: int, dst_rate: int):
+        self.src_rate, self.dst_rate = int(src_rate), int(dst_rate)
+        self.up, self.down, self.delay, self.phases = design_kernel(self.src_rate, self.dst_rate)
+        self.taps = self.phases.shape[1]
+        self._buf = None
+        self._buf_start = 0  # абсолютный индекс первого входного сэмпла в буфере
+        self._total_in = 0
+        self._n_out = 0
+
+    def _emit(self, n_end):
+        """
+        Считает выходы [n_out, n_end). Выход n берёт фазу p = (n*down + delay) % up и
+        вход до base = (n*down + delay) // up. У выходов с шагом up фаза одна и та же,
+        а base растёт на down — поэтому каждый такой класс считается одним
+        матричным умножением по strided-окнам входа.
+        """
+        up, down, taps = self.up, self.down, self.taps
+        lead = self._buf.shape[:-1]
+        pad = np.zeros(lead + (taps,), dtype=np.float32)
+        windows = sliding_window_view(np.concatenate([pad, self._buf, pad], axis=-1), taps, axis=-1)
+        chunks = []
+        for start in range(self._n_out, n_end, BLOCK):
+            count_total = min(start + BLOCK, n_end) - start
+            out = np.empty(lead + (count_total,), dtype=np.float32)
+            for r in range(min(up, count_total)):
+                count = (count_total - r + up - 1) // up
+                m0 = (start + r) * down + self.delay
+                # Окно, заканчивающееся на входе base, начинается со строки base - buf_start + 1
+                row0 = m0 // up - self._buf_start + 1
+                rows = windows[..., row0:row0 + down * (count - 1) + 1:down, :]
+                out[..., r::up] = rows @ self.phases[m0 % up]
+            chunks.append(out)
+        self._n_out = max(self._n_out, n_end)
+        if not chunks:
+            return np.zeros(lead + (0,), dtype=np.float32)
+        return np.concatenate(chunks, axis=-1)
+
+    def process(self, block):
+        """Добавляет блок входа и возвращает все выходные сэмплы, которые уже можно посчитать"""
+        block = np.asarray(block, dtype=np.float32)
+        self._buf = block if self._buf is None else np.concatenate([self._buf, block], axis=-1)
+        self._total_in += block.shape[-1]
+        # Выход n готов, когда есть вход base(n) = (n*down + delay) // up
+        n_ready = max((self._total_in * self.up - self.delay + self.down - 1) // self.down, 0)
+        out = self._emit(n_ready)
+        # Оставляем только хвост, который понадобится следующим выходам
+        keep_from = (self._n_out * self.down + self.delay) // self.up - self.taps + 1
+        drop = min(max(keep_from - self._buf_start, 0), self._buf.shape[-1])
+        self._buf = self._buf[..., drop:]
+        self._buf_start += drop
+        return out
+
+    def flush(self):
+        """Досчитывает выход до конца сигнала (хвост фильтра — нулями)"""
+        if self._buf is None:
+            return np.zeros(0, dtype=np.float32)
+        n_total = -(-self._total_in * self.up // self.down)
+        return self._emit(n_total)
+
+
+def resample(samples, src_rate: int, dst_rate: int):
+    """Передискретизация целого сигнала [..., samples] -> float32"""
+    samples = np.asarray(samples, dtype=np.float32)
+    if int(src_rate) == int(dst_rate) or samples.shape[-1] == 0:
+        return samples
+    r = StreamResampler(src_rate, dst_rate)
+    return np.concatenate([r.process(samples), r.flush()], axis=-1)
+
+
+def _bench():
+    import audioop
+
+    seconds = 30
+    print(f"{'path':<34} {'src':>6} {'dst':>6} {'time ms':>9} {'alias dB':>9}")
+    for src, dst in [(24000, 32000), (48000, 24000), (44100, 32000)]:
+        rng = np.random.default_rng(0)
+        x = (rng.standard_normal(src * seconds) * 0.1).astype(np.float32)
+        pcm = (x * 32767).astype(np.int16).tobytes()
+        # Тон выше новой частоты Найквиста: всё, что от него осталось, — алиасинг
+        tone = None  # при повышении частоты алиасинга нет
+        if dst < src:
+            t = np.arange(src * 2) / src
+            tone = (0.5 * np.sin(2 * np.pi * dst * 0.55 * t)).astype(np.float32)
+
+        design_kernel.cache_clear()
+        t0 = time.perf_counter()
+        resample(x, src, dst)
+        cold = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        resample(x, src, dst)
+        warm = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        audioop.ratecv(pcm, 2, 1, src, dst, None)
+        ratecv = (time.perf_counter() - t0) * 1000
+
+        def alias_db(y):
+            return 10 * np.log10(np.mean(y[len(y) // 4:-len(y) // 4] ** 2) / np.mean(tone ** 2) + 1e-12)
+
+        poly_alias = ratecv_alias = float("nan")
+        if tone is not None:
+            poly_alias = alias_db(resample(tone, src, dst))
+            tone_pcm = (tone * 32767).astype(np.int16).tobytes()
+            y, _ = audioop.ratecv(tone_pcm, 2, 1, src, dst, None)
+            ratecv_alias = alias_db(np.frombuffer(y, dtype=np.int16) / 32767.0)
+        print(f"{'polyphase (kernel cold)':<34} {src:>6} {dst:>6} {cold:>9.1f}")
+        print(f"{'polyphase (kernel cached)':<34} {src:>6} {dst:>6} {warm:>9.1f} {poly_alias:>9.1f}")
+        print(f"{'audioop.ratecv (pydub)':<34} {src:>6} {dst:>6} {ratecv:>9.1f} {ratecv_alias:>9.1f}")
+
+
+if __name__ == "__main__":
+    import sys
+    if "--bench" in sys.argv:
+        _bench()
+    else:
+        print(__doc__)
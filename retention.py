@@ -0,0 +1,262 @@
+"""
+Очистка OUTPUT_DIR по политикам хранения.
+
+- промежуточные файлы (vocal.wav, music.wav, результаты TTS tts_voice_*.wav и tts_multi_*.wav)
+  живут не дольше TTL;
+- для каждого названия трека хранятся только N последних версий (name, name_v2, ...;
+  суффикс версии добавляет helpers.track_output_path, песни-проекты сюда не входят);
+- общий объём папки вместе с проектами не превышает квоту (сначала удаляются самые
+  старые файлы; трек песни удаляется вместе с папкой её проекта);
+- папки проектов без готового трека (удалён или генерация упала) удаляются;
+- закреплённые (pinned) файлы не удаляются никогда.
+
+Фоновый поток запускается через start_sweeper(); sweep(dry_run=True) только
+показывает, что было бы удалено.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from colorama import Fore
+
+from helpers import OUTPUT_DIR, get_filename_only, invalidate_audio_index, log
+from projects import PROJECTS_DIR
+
+MB = 1024 * 1024
+
+INTERMEDIATE_NAMES = {"vocal.wav", "music.wav", "tts_voice.wav"}
+# Результаты TTS с уникальным именем (helpers.unique_output_path)
+INTERMEDIATE_RE = re.compile(r"^tts_(voice|multi)_\d{8}_\d{6}_[0-9a-f]{6}(_.+)?\.wav$")
+PINS_FILE = OUTPUT_DIR / ".pinned.json"
+AUDIO_PATTERNS = ("*.wav", "*.mp3")
+
+# Файлы моложе этого возраста не трогаем — их может ещё дописывать генерация
+GRACE_SECONDS = 300
+
+# Суффикс версии из helpers.track_output_path: "Leon_music_v3" -> "Leon_music";
+# другие числа в названии («demo_2», дата) — часть названия
+_VERSION_SUFFIX = re.compile(r"_v\d+$")
+
+_pins_lock = threading.Lock()
+_sweep_lock = threading.Lock()
+
+
+class RetentionPolicy:
+    def __init__(self, max_total_mb=None, intermediate_ttl_hours=None, keep_last_per_track=None,
+                 interval_minutes=None):
+        env = os.environ.get
+        self.max_total_mb = max_total_mb if max_total_mb is not None else float(env("LEON_OUTPUT_QUOTA_MB", "2048"))
+        self.intermediate_ttl_hours = (intermediate_ttl_hours if intermediate_ttl_hours is not None
+                                       else float(env("LEON_INTERMEDIATE_TTL_H", "24")))
+        self.keep_last_per_track = (keep_last_per_track if keep_last_per_track is not None
+                                    else int(env("LEON_KEEP_LAST", "5")))
+        self.interval_minutes = (interval_minutes if interval_minutes is not None
+                                 else float(env("LEON_SWEEP_INTERVAL_MIN", "30")))
+
+
+# === Закреплённые файлы ===
+
+def _read_pins():
+    try:
+        return set(json.loads(PINS_FILE.read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        return set()
+
+
+def load_pins():
+    with _pins_lock:
+        return _read_pins()
+
+
+def _save_pins(pins):
+    tmp = PINS_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(sorted(pins), ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, PINS_FILE)
+
+
+def toggle_pin(path_str):
+    """Закрепляет или открепляет файл, возвращает новое состояние"""
+    name = get_filename_only(path_str)
+    with _pins_lock:
+        pins = _read_pins()
+        pinned = name not in pins
+        if pinned:
+            pins.add(name)
+        else:
+            pins.discard(name)
+        _save_pins(pins)
+    log(f"File {'pinned' if pinned else 'unpinned'}: {name}", Fore.YELLOW)
+    return pinned
+
+
+# === Планирование удаления ===
+
+def track_group(path):
+    """Название трека без суффиксов версий"""
+    return _VERSION_SUFFIX.sub("", Path(path).stem) or Path(path).stem
+
+
+def is_intermediate(path):
+    name = Path(path).name
+    return name in INTERMEDIATE_NAMES or INTERMEDIATE_RE.match(name) is not None
+
+
+def _scan():
+    files = []
+    for pattern in AUDIO_PATTERNS:
+        for p in OUTPUT_DIR.glob(pattern):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            files.append((p, st.st_size, st.st_mtime))
+    # Новые первыми
+    files.sort(key=lambda f: f[2], reverse=True)
+    return files
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _project_sizes():
+    """{slug: байт} по всем папкам проектов"""
+    return {p.name: _dir_size(p) for p in PROJECTS_DIR.iterdir() if p.is_dir()}
+
+
+def _orphan_projects(now, sizes):
+    """Папки проектов, у которых больше нет готового трека в OUTPUT_DIR"""
+    for name, size in sizes.items():
+        project = PROJECTS_DIR / name
+        if (OUTPUT_DIR / f"{name}.wav").exists():
+            continue
+        try:
+            mtime = project.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if now - mtime > GRACE_SECONDS:
+            yield project, size
+
+
+def plan_sweep(policy, now=None):
+    """Возвращает список (path, size, reason) файлов, которые нарушают политики"""
+    now = now or time.time()
+    pins = load_pins()
+    scanned = _scan()
+    files = [f for f in scanned if f[0].name not in pins]
+    doomed = {}
+
+    def deletable(mtime):
+        return now - mtime > GRACE_SECONDS
+
+    # 1. TTL промежуточных файлов
+    ttl = policy.intermediate_ttl_hours * 3600
+    for path, size, mtime in files:
+        if is_intermediate(path) and now - mtime > ttl:
+            doomed[path] = (size, f"intermediate older than {policy.intermediate_ttl_hours:g}h")
+
+    # 2. Только N последних версий каждого трека (свежие файлы тоже считаются версиями)
+    if policy.keep_last_per_track > 0:
+        seen = {}
+        for path, size, mtime in files:
+            # Трек песни — одна версия своего проекта, его судьбу решает проект
+            if is_intermediate(path) or (PROJECTS_DIR / path.stem).is_dir():
+                continue
+            group = track_group(path)
+            seen[group] = seen.get(group, 0) + 1
+            if seen[group] > policy.keep_last_per_track and deletable(mtime):
+                doomed.setdefault(path, (size, f"more than {policy.keep_last_per_track} versions of '{group}'"))
+
+    projects = _project_sizes()
+    for project, size in _orphan_projects(now, projects):
+        doomed[project] = (size, "project without rendered track")
+
+    # 3. Квота: удаляем самые старые, пока не влезем (закреплённые всё равно занимают место).
+    # Стемы проектов — основной объём: трек песни уходит вместе со своим проектом
+    quota = policy.max_total_mb * MB
+    total = sum(f[1] for f in scanned) + sum(projects.values()) - sum(size for size, _ in doomed.values())
+    for path, size, mtime in reversed(files):
+        if total <= quota:
+            break
+        if path in doomed or not deletable(mtime):
+            continue
+        reason = f"over quota {policy.max_total_mb:g} MB"
+        doomed[path] = (size, reason)
+        total -= size
+        project = PROJECTS_DIR / path.stem
+        if path.stem in projects and project not in doomed:
+            doomed[project] = (projects[path.stem], reason)
+            total -= projects[path.stem]
+
+    return [(path, size, reason) for path, (size, reason) in doomed.items()]
+
+
+def sweep(policy=None, dry_run=False):
+    """Удаляет файлы по плану одним пакетом; возвращает отчёт"""
+    policy = policy or RetentionPolicy()
+    with _sweep_lock:
+        plan = plan_sweep(policy)
+        deleted = []
+        if not dry_run:
+            for path, size, reason in plan:
+                try:
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    else:
+                        path.unlink()
+                    deleted.append((path, size, reason))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    log(f"[Retention] Cannot delete {path.name}: {e}", Fore.RED)
+            if deleted:
+                # Один сброс кэша на весь пакет
+                invalidate_audio_index()
+                log(f"[Retention] Deleted {len(deleted)} files, "
+                    f"reclaimed {sum(d[1] for d in deleted) / MB:.1f} MB", Fore.YELLOW)
+    entries = plan if dry_run else deleted
+    return {
+        "dry_run": dry_run,
+        "files": [{"name": p.name, "size": size, "reason": reason} for p, size, reason in entries],
+        "reclaimed_bytes": sum(e[1] for e in entries),
+    }
+
+
+def format_report(report):
+    if not report["files"]:
+        return "🧹 Нечего удалять — все файлы в пределах политик"
+    head = "Будет удалено" if report["dry_run"] else "Удалено"
+    lines = [f"{head}: {len(report['files'])} файлов, {report['reclaimed_bytes'] / MB:.1f} МБ"]
+    lines += [f"• {f['name']} ({f['size'] / MB:.1f} МБ) — {f['reason']}" for f in report["files"]]
+    return "\n".join(lines)
+
+
+# === Фоновый поток ===
+
+_sweeper = None
+
+
+def start_sweeper(policy=None):
+    """Запускает фоновую очистку с интервалом policy.interval_minutes (0 — выключено)"""
+    global _sweeper
+    policy = policy or RetentionPolicy()
+    if _sweeper is not None or policy.interval_minutes <= 0:
+        return _sweeper
+
+    def run():
+        while True:
+            try:
+                sweep(policy)
+            except Exception as e:
+                log(f"[Retention] Sweep failed: {e}", Fore.RED)
+            time.sleep(policy.interval_minutes * 60)
+
+    _sweeper = threading.Thread(target=run, name="leon-retention", daemon=True)
+    _sweeper.start()
+    log(f"[Retention] Sweeper started: quota {policy.max_total_mb:g} MB, "
+        f"keep last {policy.keep_last_per_track} per track, every {policy.interval_minutes:g} min")
+    return _sweeper
@@ -0,0 +1,158 @@
+"""
+Планировщик генераций: короткие задания — первыми.
+
+Модели общие на процесс, поэтому одновременно выполняется SLOTS заданий, а остальные
+ждут здесь, а не в FIFO-очередях Gradio и пула заданий. Когда слот освобождается,
+из ожидающих выбирается задание с наименьшим приоритетом:
+
+    оценка времени (cost_model) + FAIRNESS * недавнее время пользователя - AGING * время ожидания
+
+Старение не даёт длинным заданиям голодать (рано или поздно их приоритет
+становится меньше, чем у любого нового), а учёт недавнего времени пользователя
+не даёт одному клиенту занять модели серией коротких запросов.
+"""
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from cancellation import Cancelled, check, wasted
+from helpers import log
+
+SLOTS = int(os.environ.get("LEON_SCHED_SLOTS", "1"))
+# Секунд приоритета за секунду ожидания
+AGING = float(os.environ.get("LEON_SCHED_AGING", "0.5"))
+# Вес уже потраченного пользователем времени моделей
+FAIRNESS = float(os.environ.get("LEON_SCHED_FAIRNESS", "0.5"))
+# Время пользователя затухает с этим периодом полураспада, с
+USAGE_HALF_LIFE = float(os.environ.get("LEON_SCHED_HALF_LIFE", "600"))
+STATUS_INTERVAL = 1.0
+# Сколько обработчиков Gradio и заданий API может одновременно ждать здесь своей очереди
+QUEUE_CONCURRENCY = int(os.environ.get("LEON_QUEUE_CONCURRENCY", "8"))
+# Предел очереди: ожидающие здесь + задания API, ещё не дошедшие до планировщика
+MAX_WAITING = int(os.environ.get("LEON_SCHED_QUEUE", str(2 * QUEUE_CONCURRENCY)))
+
+
+class QueueFull(Exception):
+    """Очередь планировщика переполнена — клиенту стоит повторить позже"""
+
+
+class _Waiter:
+    def __init__(self, seq, kind, cost, user):
+        self.seq = seq
+        self.kind = kind
+        self.cost = cost
+        self.user = user
+        self.arrived = time.time()
+
+
+class Scheduler:
+    def __init__(self, slots=SLOTS, max_waiting=MAX_WAITING):
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {}  # seq -> (waiter, время старта)
+        self._usage = {}    # user -> (секунды, момент обновления)
+        self._seq = itertools.count()
+        # fn(kind, user, секунд в очереди) при каждом старте — для нагрузочного теста и метрик
+        self._listeners = []
+
+    def _user_usage(self, user, now):
+        seconds, updated = self._usage.get(user, (0.0, now))
+        return seconds * math.pow(0.5, (now - updated) / USAGE_HALF_LIFE)
+
+    def _charge(self, user, seconds, now):
+        self._usage[user] = (self._user_usage(user, now) + seconds, now)
+
+    def _priority(self, w, now):
+        return w.cost + FAIRNESS * self._user_usage(w.user, now) - AGING * (now - w.arrived)
+
+    def _order(self, now):
+        return sorted(self._waiting, key=lambda w: (self._priority(w, now), w.seq))
+
+    def _eta(self, me, now):
+        """(позиция в очереди, секунд до старта) — по оценкам тех, кто впереди и выполняется"""
+        ahead = list(itertools.takewhile(lambda w: w is not me, self._order(now)))
+        remaining = sorted(max(w.cost - (now - started), 0.0) for w, started in self._running.values())
+        free_in = remaining[0] if len(remaining) >= self.slots else 0.0
+        return len(ahead) + 1, free_in + sum(w.cost for w in ahead) / self.slots
+
+    @contextmanager
+    def slot(self, kind, cost, user=None, progress_fn=None, cancel_token=None, held=False):
+        """
+        Ждёт своей очереди и занимает слот на время блока; cost — оценка в секундах.
+        Отменённое задание уходит из очереди, а отменённое на ходу — учитывается как потерянное время.
+        held=True — вызывающий уже держит слот (черновик -> генерация), блок выполняется сразу.
+        Слот не привязан к потоку: генератор может продолжаться на других потоках Gradio.
+        """
+        if held:
+            yield
+            return
+
+        user = user or "anonymous"
+        with self._cond:
+            if len(self._waiting) >= self.max_waiting:
+                raise QueueFull(f"Generation queue is full ({len(self._waiting)} waiting), try again later")
+            me = _Waiter(next(self._seq), kind, cost, user)
+            self._waiting.append(me)
+            try:
+                while True:
+                    check(cancel_token)
+                    now = time.time()
+                    if len(self._running) < self.slots and self._order(now)[0] is me:
+                        break
+                    if progress_fn:
+                        position, eta = self._eta(me, now)
+                        progress_fn(0.0, f"⏳ В очереди: {position}-й, старт через ~{eta:.0f}с")
+                    self._cond.wait(STATUS_INTERVAL)
+            finally:
+                self._waiting.remove(me)
+                # Следующий в очереди мог стать первым
+                self._cond.notify_all()
+            started = time.time()
+            self._running[me.seq] = (me, started)
+            waited = started - me.arrived
+        if waited > 1:
+            log(f"[Scheduler] {kind} ({cost:.0f}s est.) for {user[:8]} started after {waited:.1f} sec in queue")
+        for fn in self._listeners:
+            fn(kind, user, waited)
+        try:
+            yield
+        except Cancelled:
+            wasted.record(kind, time.time() - started)
+            raise
+        finally:
+            with self._cond:
+                now = time.time()
+                del self._running[me.seq]
+                self._charge(user, now - started, now)
+                self._cond.notify_all()
+
+    def add_listener(self, fn):
+        """fn(kind, user, waited) вызывается в потоке задания сразу после получения слота"""
+        self._listeners.append(fn)
+
+    def is_saturated(self, pending=0):
+        """Очередь заполнена с учётом pending заданий, которые ещё только встанут в неё"""
+        with self._cond:
+            return len(self._waiting) + pending >= self.max_waiting
+
+    def snapshot(self):
+        with self._cond:
+            now = time.time()
+            return {
+                "slots": self.slots,
+                "max_waiting": self.max_waiting,
+                "running": [{"kind": w.kind, "user": w.user[:8], "estimate": round(w.cost, 1),
+                             "elapsed": round(now - started, 1)} for w, started in self._running.values()],
+                "waiting": [{"kind": w.kind, "user": w.user[:8], "estimate": round(w.cost, 1),
+                             "waited": round(now - w.arrived, 1), "priority": round(self._priority(w, now), 1)}
+                            for w in self._order(now)],
+            }
+
+
+# Общий планировщик процесса
+scheduler = Scheduler()
@@ -0,0 +1,91 @@
+"""
+Лёгкие заглушки вместо MusicGen и XTTS для локальной проверки API и нагрузочных тестов.
+
+Включаются переменной окружения LEON_STUB_MODELS=1 до импорта music_workflow.
+Задержка генерации имитируется по тем же порядкам величин, что и у реальных моделей.
+"""
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from pydub import AudioSegment
+
+# Множитель задержки: LEON_STUB_LATENCY=0 отключает ожидание полностью
+LATENCY_SCALE = float(os.environ.get("LEON_STUB_LATENCY", "0.05"))
+
+
+def _sleep(seconds):
+    if LATENCY_SCALE > 0:
+        # Логнормальный разброс, как у реальных генераций
+        time.sleep(seconds * LATENCY_SCALE * random.lognormvariate(0, 0.25))
+
+
+class StubMusicGen:
+    """Повторяет интерфейс audiocraft MusicGen, который использует music_workflow"""
+    sample_rate = 32000
+
+    # Шагов токенов на секунду аудио, как у EnCodec 32 кГц
+    frame_rate = 50
+
+    def __init__(self, name="stub"):
+        self.name = name
+        self.duration = 10
+        self._progress_callback = None
+
+    @classmethod
+    def get_pretrained(cls, name):
+        return cls(name)
+
+    def set_generation_params(self, duration=10, **kwargs):
+        self.duration = duration
+
+    def set_custom_progress_callback(self, callback=None):
+        self._progress_callback = callback
+
+    def _run_steps(self, progress):
+        """Задержка генерации кусками с колбэком прогресса между ними, как в audiocraft"""
+        total = int(self.duration * self.frame_rate)
+        chunks = 20
+        for i in range(chunks):
+            _sleep(self.duration * 1.5 / chunks)
+            if progress and self._progress_callback is not None:
+                self._progress_callback(total * (i + 1) // chunks, total)
+
+    def generate(self, descriptions, progress=False):
+        self._run_steps(progress)
+        n = int(self.sample_rate * self.duration)
+        t = np.arange(n, dtype=np.float32) / self.sample_rate
+        wav = 0.2 * np.sin(2 * np.pi * 220.0 * t)
+        return torch.from_numpy(np.tile(wav, (len(descriptions), 1, 1)))
+
+    def generate_continuation(self, prompt, prompt_sample_rate, descriptions=None, progress=False):
+        out = self.generate(descriptions or [None], progress=progress)
+        n = min(prompt.shape[-1], out.shape[-1])
+        out[..., :n] = prompt[..., :n]
+        return out
+
+
+class StubTTS:
+    """Повторяет интерфейс TTS.api.TTS: пишет тихий тон длиной по тексту"""
+    sample_rate = 24000
+
+    def __init__(self, model_name=None, progress_bar=False):
+        self.model_name = model_name
+
+    def _samples(self, text):
+        _sleep(len(text) * 0.2)
+        n = int(self.sample_rate * max(len(text) * 0.06, 0.5))
+        t = np.arange(n, dtype=np.float32) / self.sample_rate
+        return 0.1 * np.sin(2 * np.pi * 330.0 * t)
+
+    def tts(self, text, speaker_wav=None, language=None, **kwargs):
+        return self._samples(text).tolist()
+
+    def tts_to_file(self, text, speaker_wav=None, language=None, file_path="output.wav", **kwargs):
+        audio_int16 = (self._samples(text) * 32767).astype(np.int16)
+        AudioSegment(
+            audio_int16.tobytes(), frame_rate=self.sample_rate, sample_width=2, channels=1
+        ).export(file_path, format="wav")
+        return file_path
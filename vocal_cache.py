@@ -0,0 +1,227 @@
+"""
+Построчный синтез вокала с кэшем.
+
+В текстах песен припев и хуки повторяются, поэтому текст режется на строки,
+каждая уникальная пара (строка, голос, язык) синтезируется один раз и хранится
+в памяти (LRU, лимит LEON_VOCAL_CACHE_MB). Вокальная дорожка собирается из
+сегментов с паузой gap_ms между строками и кроссфейдом crossfade_ms на стыках.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from cancellation import check
+from helpers import log
+
+CACHE_MB = float(os.environ.get("LEON_VOCAL_CACHE_MB", "64"))
+GAP_MS = int(os.environ.get("LEON_VOCAL_GAP_MS", "150"))
+CROSSFADE_MS = int(os.environ.get("LEON_VOCAL_CROSSFADE_MS", "30"))
+# Тишина по краям сегмента, которую XTTS добавляет к каждой фразе
+SILENCE_DB = -50.0
+
+# Пометки разделов: [Chorus], (Verse 2), Chorus:
+_SECTION_RE = re.compile(
+    r"^(\[[^\]]*\]|\(?(verse|chorus|pre-chorus|bridge|hook|intro|outro)\s*\d*\)?\s*:?)$", re.I)
+# Повтор строки: «Sing it x2», «Sing it (x2)»
+_REPEAT_RE = re.compile(r"\s+\(?[x×]\s*(\d+)\)?$", re.I)
+
+
+def split_lines(lyrics):
+    """Текст -> список строк для синтеза (без пустых строк и пометок разделов, «x2» разворачивается)"""
+    lines = []
+    for raw in lyrics.splitlines():
+        line = " ".join(raw.split())
+        if not line or _SECTION_RE.match(line):
+            continue
+        repeat = _REPEAT_RE.search(line)
+        count = 1
+        if repeat:
+            count = min(int(repeat.group(1)), 8)
+            line = line[:repeat.start()]
+        lines.extend([line] * count)
+    return lines
+
+
+def normalize_line(line):
+    """Ключ строки: регистр, пробелы и пунктуация по краям не влияют на синтез повтора"""
+    return " ".join(line.casefold().split()).strip(" .,;:!?-—–\"'")
+
+
+def _voice_key(voice_path):
+    path = Path(voice_path).resolve()
+    try:
+        return str(path), path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return str(path), None
+
+
+def _trim(x, sample_rate):
+    """Обрезает тишину по краям сегмента, оставляя 10 мс"""
+    threshold = 10 ** (SILENCE_DB / 20)
+    loud = np.flatnonzero(np.abs(x) > threshold)
+    if not len(loud):
+        return x
+    margin = int(sample_rate * 0.01)
+    return x[max(loud[0] - margin, 0):loud[-1] + margin + 1]
+
+
+def assemble(segments, sample_rate, gap_ms=GAP_MS, crossfade_ms=CROSSFADE_MS):
+    """Склеивает сегменты: пауза gap_ms, последние crossfade_ms строки накладываются на начало следующей"""
+    gap = np.zeros(max(int(sample_rate * gap_ms / 1000), 0), dtype=np.float32)
+    fade = max(int(sample_rate * crossfade_ms / 1000), 0)
+    parts = []
+    for i, seg in enumerate(segments):
+        seg = seg.copy()
+        if fade:
+            n = min(fade, len(seg) // 2)
+            if i > 0:
+                seg[:n] *= np.linspace(0.0, 1.0, n, dtype=np.float32)
+            if i < len(segments) - 1:
+                seg[len(seg) - n:] *= np.linspace(1.0, 0.0, n, dtype=np.float32)
+        parts.append(seg)
+
+    total = sum(len(p) for p in parts) + len(gap) * max(len(parts) - 1, 0)
+    out = np.zeros(total, dtype=np.float32)
+    pos = 0
+    for i, seg in enumerate(parts):
+        if i > 0:
+            # Нахлёст: при нулевой паузе строки переходят друг в друга
+            pos = max(pos + len(gap) - min(fade, len(seg) // 2, pos), 0)
+        out[pos:pos + len(seg)] += seg
+        pos += len(seg)
+    return out[:pos]
+
+
+class VocalCache:
+    def __init__(self, max_mb=CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.synthesized = 0
+        self.saved = 0
+
+    def _get(self, key):
+        with self._lock:
+            seg = self._items.get(key)
+            if seg is not None:
+                self._items.move_to_end(key)
+            return seg
+
+    def _put(self, key, seg):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if seg.nbytes > self.max_bytes:
+                return
+            self._items[key] = seg
+            self._bytes += seg.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def plan(self, lyrics, voice_path, language="en"):
+        """(строки, ключи, число символов, которые ещё нужно синтезировать) — для оценки времени"""
+        voice = _voice_key(voice_path)
+        lines = split_lines(lyrics)
+        keys = [(normalize_line(line), voice, language) for line in lines]
+        missing, seen = 0, set()
+        for line, key in zip(lines, keys):
+            if key not in seen and self._get(key) is None:
+                missing += len(line)
+            seen.add(key)
+        return lines, keys, missing
+
+    def synthesize(self, tts_fn, lyrics, voice_path, sample_rate, language="en",
+                   gap_ms=GAP_MS, crossfade_ms=CROSSFADE_MS, on_line=None, cancel_token=None):
+        """
+        tts_fn(text=, speaker_wav=, language=) -> сэмплы. Возвращает (float32 моно, статистика).
+        on_line(i, total) вызывается после каждой строки; отмена проверяется между строками.
+        """
+        lines, keys, _ = self.plan(lyrics, voice_path, language)
+        if not lines:
+            raise Exception("Lyrics are empty")
+        segments, calls, reused, chars = [], 0, 0, 0
+        for i, (line, key) in enumerate(zip(lines, keys)):
+            check(cancel_token)
+            seg = self._get(key)
+            if seg is None:
+                seg = _trim(np.asarray(tts_fn(text=line, speaker_wav=voice_path, language=language),
+                                       dtype=np.float32), sample_rate)
+                seg.setflags(write=False)
+                self._put(key, seg)
+                calls += 1
+                chars += len(line)
+            else:
+                reused += 1
+            segments.append(seg)
+            if on_line:
+                on_line(i + 1, len(lines))
+
+        with self._lock:
+            self.synthesized += calls
+            self.saved += reused
+        stats = {"lines": len(lines), "unique": len(set(keys)), "synthesized": calls, "saved": reused,
+                 "chars": chars}
+        log(f"[VocalCache] {stats['lines']} lines, {stats['unique']} unique: "
+            f"{calls} synthesized, {reused} reused from cache")
+        return assemble(segments, sample_rate, gap_ms, crossfade_ms), stats
+
+    def synthesize_many(self, batch_fn, lyrics, voice_paths, sample_rate, language="en",
+                        on_line=None, cancel_token=None):
+        """
+        Один текст несколькими голосами. batch_fn(text, voices, language) -> сэмплы по голосам;
+        в него попадают только голоса, которых для строки нет в кэше.
+        Возвращает (ключи строк, {голос: [сегменты]}, статистика).
+        """
+        plans = {voice: self.plan(lyrics, voice, language) for voice in voice_paths}
+        lines = plans[voice_paths[0]][0]
+        if not lines:
+            raise Exception("Lyrics are empty")
+        segments = {voice: [] for voice in voice_paths}
+        calls, batches, reused, chars = 0, 0, 0, 0
+        for i, line in enumerate(lines):
+            check(cancel_token)
+            missing = []
+            for voice in voice_paths:
+                seg = self._get(plans[voice][1][i])
+                if seg is None:
+                    missing.append(voice)
+                else:
+                    reused += 1
+                segments[voice].append(seg)
+            if missing:
+                for voice, samples in zip(missing, batch_fn(line, missing, language)):
+                    seg = _trim(np.asarray(samples, dtype=np.float32), sample_rate)
+                    seg.setflags(write=False)
+                    self._put(plans[voice][1][i], seg)
+                    segments[voice][i] = seg
+                calls += len(missing)
+                batches += 1
+                chars += len(line) * len(missing)
+            if on_line:
+                on_line(i + 1, len(lines))
+
+        with self._lock:
+            self.synthesized += calls
+            self.saved += reused
+        keys = [key[0] for key in plans[voice_paths[0]][1]]
+        stats = {"lines": len(lines), "voices": len(voice_paths), "synthesized": calls, "batches": batches,
+                 "saved": reused, "chars": chars}
+        log(f"[VocalCache] {len(lines)} lines x {len(voice_paths)} voices: {calls} synthesized "
+            f"in {batches} batches, {reused} reused from cache")
+        return keys, segments, stats
+
+    def snapshot(self):
+        with self._lock:
+            return {"segments": len(self._items), "mb": round(self._bytes / 1024 / 1024, 1),
+                    "synthesized": self.synthesized, "saved": self.saved}
+
+
+# Общий кэш процесса
+cache = VocalCache()
@@ -0,0 +1,178 @@
+"""
+Чтение WAV без декодирования всего файла.
+
+PCM/float WAV отображается в память (np.memmap): заголовок RIFF разбирается сам,
+а данные остаются на диске, пока к ним не обратились. view() отдаёт сырые сэмплы
+без копии, read() переводит в float32 только запрошенный отрезок (с точностью до
+сэмпла) и только нужные каналы. Поддерживаются PCM 8/16/24/32 бит, float 32/64
+и WAVE_FORMAT_EXTENSIBLE; сжатые форматы (mp3, ADPCM и т.п.) декодируются pydub
+целиком, с тем же интерфейсом.
+"""
+import os
+import struct
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (формат, байт на сэмпл) -> dtype сырых данных; 24 бит читается как 3 байта
+_DTYPES = {
+    (WAVE_FORMAT_PCM, 1): np.dtype("u1"),
+    (WAVE_FORMAT_PCM, 2): np.dtype("<i2"),
+    (WAVE_FORMAT_PCM, 3): np.dtype("u1"),
+    (WAVE_FORMAT_PCM, 4): np.dtype("<i4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 4): np.dtype("<f4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 8): np.dtype("<f8"),
+}
+
+
+def _parse_header(path):
+    """(формат, каналы, частота, байт на сэмпл, смещение данных, кадров) или None, если файл не отобразить"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        fmt = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", head)
+            if chunk_id == b"fmt ":
+                body = f.read(chunk_size)
+                if len(body) < 16:
+                    return None
+                tag, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", body[:16])
+                if tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # Реальный формат — первые два байта GUID подформата
+                    tag = struct.unpack("<H", body[24:26])[0]
+                fmt = (tag, channels, rate, block_align // max(channels, 1))
+                f.seek(chunk_size & 1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    return None
+                tag, channels, rate, width = fmt
+                if (tag, width) not in _DTYPES or not channels:
+                    return None
+                offset = f.tell()
+                # Размер может быть не дописан (0xFFFFFFFF у потоковой записи) — верим длине файла
+                data_size = min(chunk_size, size - offset)
+                return tag, channels, rate, width, offset, data_size // (channels * width)
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+class _Audio:
+    """Общая часть: сырые сэмплы self._data [кадры, каналы] и их перевод во float32"""
+
+    def __init__(self, path, data, sample_rate, sample_width, format_tag):
+        self.path = str(path)
+        self._data = data
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.format_tag = format_tag
+        self.channels = data.shape[1]
+        self.frames = data.shape[0]
+
+    def __len__(self):
+        return self.frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def duration(self):
+        return self.frames / self.sample_rate if self.sample_rate else 0.0
+
+    def frame_at(self, seconds):
+        """Номер кадра для момента seconds (в пределах файла)"""
+        return min(max(int(round(seconds * self.sample_rate)), 0), self.frames)
+
+    def view(self, start=0, stop=None):
+        """Сырые кадры [start, stop) без копии: [кадры, каналы] (для 24 бит — [кадры, каналы, 3] байт)"""
+        return self._data[slice(start, stop)]
+
+    def read(self, start=0, stop=None, channel=None, mono=False):
+        """
+        Кадры [start, stop) как float32 [-1, 1]: [каналы, сэмплы], либо [сэмплы] для одного
+        канала (channel) или среднего по каналам (mono). Переводится только этот отрезок.
+        """
+        raw = self.view(start, stop)
+        if channel is not None:
+            raw = raw[:, channel:channel + 1]
+        x = self._convert(raw)
+        if channel is not None:
+            return x[:, 0]
+        if mono:
+            return x.mean(axis=1, dtype=np.float32) if self.channels > 1 else x[:, 0]
+        return np.ascontiguousarray(x.T)
+
+    def read_seconds(self, start=0.0, end=None, **kwargs):
+        """read() по времени в секундах"""
+        return self.read(self.frame_at(start), None if end is None else self.frame_at(end), **kwargs)
+
+    def _convert(self, raw):
+        if self.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            return raw.astype(np.float32)
+        if self.sample_width == 1:
+            return (raw.astype(np.float32) - 128.0) / 128.0
+        if self.sample_width == 3:
+            # Знак — в старшем байте; собираем int32 сдвигами
+            x = (raw[..., 0].astype(np.int32) | (raw[..., 1].astype(np.int32) << 8)
+                 | (raw[..., 2].astype(np.int8).astype(np.int32) << 16))
+            return x.astype(np.float32) / np.float32(1 << 23)
+        return raw.astype(np.float32) / np.float32(1 << (8 * self.sample_width - 1))
+
+    def close(self):
+        """Отпускает данные; отображение закрывается, когда уйдут и выданные view()"""
+        self._data = self._data[:0].copy()
+
+
+class MappedWav(_Audio):
+    """PCM/float WAV, отображённый в память"""
+
+    def __init__(self, path, header):
+        tag, channels, rate, width, offset, frames = header
+        dtype = _DTYPES[(tag, width)]
+        shape = (frames, channels, 3) if width == 3 else (frames, channels)
+        if frames:
+            data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            data = np.zeros(shape, dtype=dtype)
+        super().__init__(path, data, rate, width, tag)
+
+
+class DecodedAudio(_Audio):
+    """Сжатый или нестандартный файл: декодируется pydub целиком"""
+
+    def __init__(self, path):
+        from pydub import AudioSegment
+        seg = AudioSegment.from_file(path)
+        # Файл всё равно декодирован целиком — сразу храним float32, как раньше audio_read
+        samples = np.array(seg.get_array_of_samples(), dtype=np.float32)
+        samples /= float(1 << (8 * seg.sample_width - 1))
+        super().__init__(path, samples.reshape(-1, seg.channels), seg.frame_rate, 4, WAVE_FORMAT_IEEE_FLOAT)
+
+
+def open_audio(path):
+    """MappedWav для PCM/float WAV, иначе DecodedAudio"""
+    header = _parse_header(path)
+    if header is None:
+        return DecodedAudio(path)
+    return MappedWav(path, header)
+
+
+def audio_info(path):
+    """{"sample_rate", "channels", "frames", "duration"} по заголовку WAV без чтения данных; None для других форматов"""
+    header = _parse_header(path)
+    if header is None:
+        return None
+    _, channels, rate, _, _, frames = header
+    return {"sample_rate": rate, "channels": channels, "frames": frames,
+            "duration": frames / rate if rate else 0.0}
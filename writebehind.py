@@ -0,0 +1,209 @@
+"""
+Отложенная запись результатов на диск.
+
+Генерация отдаёт готовый буфер писателю и сразу возвращает путь: интерфейс
+показывает аудио из памяти, пока фоновый поток пишет WAV во временный файл,
+делает fsync и атомарно переименовывает его на место. Очередь ограничена
+(LEON_WRITE_QUEUE) — при переполнении submit ждёт. При выходе из процесса
+все поставленные записи дописываются. Ошибки записи попадают в WriteTicket.
+Удалённый до записи файл (discard) не появится на диске.
+"""
+import atexit
+import os
+import queue
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from audio_utils import audio_write
+from helpers import invalidate_audio_index, log, set_output_pending
+
+QUEUE_DEPTH = int(os.environ.get("LEON_WRITE_QUEUE", "4"))
+
+
+class WriteTicket:
+    def __init__(self, path, audio, sample_rate, apply_export_rate):
+        self.path = Path(path)
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.apply_export_rate = apply_export_rate
+        self.error = None
+        # Файл удалили, пока запись стояла в очереди
+        self.discarded = False
+        # Предыдущая запись того же пути, ещё стоящая в очереди
+        self.previous = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Ждёт записи; пробрасывает ошибку записи"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Write of {self.path.name} is still pending")
+        if self.error:
+            raise Exception(f"Write of {self.path.name} failed: {self.error}")
+        return str(self.path)
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, error=None):
+        self.error = error
+        self.audio = None  # буфер больше не нужен
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log(f"[Writer] Callback error: {e}")
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # Windows не даёт открыть папку — там rename и так атомарен
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class OutputWriter:
+    def __init__(self, depth=QUEUE_DEPTH):
+        self._queue = queue.Queue(maxsize=depth)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="leon-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, path, audio, sample_rate, apply_export_rate=True):
+        """Ставит запись в очередь (ждёт, если очередь полна) и возвращает WriteTicket"""
+        if self._closed:
+            raise Exception("Output writer is shut down")
+        audio = audio.cpu().numpy() if hasattr(audio, "cpu") else np.asarray(audio)
+        if audio.ndim > 1:
+            audio = audio[0]
+        ticket = WriteTicket(path, audio, sample_rate, apply_export_rate)
+        key = str(ticket.path.resolve())
+        with self._lock:
+            previous = self._pending.get(key)
+            self._pending[key] = ticket
+        set_output_pending(key, True)
+        if previous is not None:
+            # Тот же путь уже в очереди: новая запись всё равно ляжет после неё
+            ticket.previous = previous
+            log(f"[Writer] {ticket.path.name} is overwritten while the previous write is pending")
+        self._queue.put(ticket)
+        return ticket
+
+    def ticket_for(self, path):
+        if not path:
+            return None
+        with self._lock:
+            return self._pending.get(str(Path(path).resolve()))
+
+    def wait_for(self, path, timeout=None):
+        """Если файл ещё пишется — ждёт окончания записи"""
+        ticket = self.ticket_for(path)
+        if ticket is not None:
+            ticket.wait(timeout)
+
+    def discard(self, path):
+        """Отменяет ожидающие записи файла (его удаляют); True, если такие были"""
+        key = str(Path(path).resolve())
+        with self._lock:
+            ticket = self._pending.pop(key, None)
+            if ticket is None:
+                return False
+            set_output_pending(key, False)
+            while ticket is not None:
+                ticket.discarded = True
+                ticket = ticket.previous
+        invalidate_audio_index()
+        return True
+
+    def pending_audio(self, path):
+        """(sample_rate, int16 массив) для файла, который ещё не записан, иначе None"""
+        ticket = self.ticket_for(path)
+        audio = ticket.audio if ticket is not None else None
+        if audio is None:
+            return None
+        return ticket.sample_rate, (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+
+    def _run(self):
+        while True:
+            ticket = self._queue.get()
+            if ticket is None:
+                self._queue.task_done()
+                return
+            self._write(ticket)
+            self._queue.task_done()
+
+    def _write(self, ticket):
+        path = ticket.path
+        ticket.previous = None
+        if ticket.discarded:
+            ticket._finish("file was deleted before it was written")
+            return
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        error = None
+        try:
+            audio_write(str(tmp), ticket.audio, ticket.sample_rate, ticket.apply_export_rate)
+            with open(tmp, "rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            _fsync_dir(path.parent)
+            # discard() мог прийти во время записи
+            if ticket.discarded:
+                path.unlink(missing_ok=True)
+                error = "file was deleted before it was written"
+        except Exception as e:
+            error = str(e)
+            log(f"[Writer] Failed to write {path.name}: {e}")
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+        key = str(path.resolve())
+        with self._lock:
+            if self._pending.get(key) is ticket:
+                del self._pending[key]
+                set_output_pending(key, False)
+        invalidate_audio_index()
+        ticket._finish(error)
+
+    def close(self):
+        """Дописывает всё из очереди и останавливает поток"""
+        if self._closed:
+            return
+        self._closed = True
+        pending = self._queue.qsize()
+        if pending:
+            log(f"[Writer] Flushing {pending} pending writes...")
+        self._queue.put(None)
+        self._thread.join()
+
+
+writer = OutputWriter()
+atexit.register(writer.close)
+
+
+def ui_audio(path):
+    """Для Gradio: аудио из памяти, если файл ещё пишется, иначе путь"""
+    return writer.pending_audio(path) or path